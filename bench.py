@@ -0,0 +1,245 @@
+"""Headless performance benchmarks.
+
+    python bench.py                    # run everything, compare to baseline
+    python bench.py --filter status    # only scenarios containing 'status'
+    python bench.py --save-baseline    # store the results as new baseline
+    python bench.py --check            # exit 1 on regressions
+
+Every scenario is timed --repeat times after a warm-up run and reported
+as median and 95th percentile in milliseconds.
+"""
+import os
+# no window and no sound; draw benchmarks render into a dummy display
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import random
+import sys
+from time import perf_counter
+
+import pygame as pg
+
+from settings import *
+from sprites import Item, Obstacle
+from tilemap import Map, ChunkedMap, TiledMap, CompiledMap, load_compiled_map
+from game import Game
+import levels
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+
+def measure(fn, repeat, setup=None):
+    """Median and p95 in ms of fn() over repeat runs (after one warm-up)."""
+    times = []
+    for i in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        fn()
+        times.append(1000 * (perf_counter() - start))
+    times = sorted(times[1:])
+    return {'median_ms': times[len(times) // 2],
+            'p95_ms': times[min(len(times) - 1, int(0.95 * len(times)))]}
+
+def arena_level(walls=0, items=0, mobs=0, players=0, size=200):
+    """Level class of an open size x size tile arena with random content."""
+    class ArenaLevel(levels.Level):
+        def make_map(self):
+            self.map = Map(size, size)
+            self.game.map = self.map
+            self.game.map_renderer = ChunkedMap(self.map.width,
+                                                self.map.height,
+                                                self.render_region)
+
+        def render_region(self, surface, rect):
+            surface.fill(GREEN)
+
+        def random_pos(self, rng):
+            # keep the middle free for the player
+            while True:
+                col, row = rng.randrange(size), rng.randrange(size)
+                if abs(col - size // 2) > 2 or abs(row - size // 2) > 2:
+                    return col * TILESIZE, row * TILESIZE
+
+        def new(self):
+            game = self.game
+            rng = random.Random(0)
+            center = size // 2 * TILESIZE + TILESIZE / 2
+            game.player = game.player_class(game, center, center)
+            for i in range(walls):
+                x, y = self.random_pos(rng)
+                Obstacle(game, x, y, TILESIZE, TILESIZE)
+            for i in range(items):
+                x, y = self.random_pos(rng)
+                Item(game, pg.math.Vector2(x + TILESIZE / 2, y + TILESIZE / 2),
+                     'apple')
+            for i in range(mobs):
+                x, y = self.random_pos(rng)
+                game.mob_class(game, x + TILESIZE / 2, y + TILESIZE / 2)
+            for i in range(players):
+                x, y = self.random_pos(rng)
+                player = game.player_class(game, x + TILESIZE / 2,
+                                           y + TILESIZE / 2)
+                player.reply = lambda result: None
+                player.go_forward(rng.randrange(1, 5))
+    return ArenaLevel
+
+def start(game, level_cls):
+    game.set_level(level_cls)
+    game.new()
+    return game
+
+def bench_mazes(results, repeat):
+    for method, size in [('backtracker', 10), ('backtracker', 100),
+                         ('backtracker', 300), ('sidewinder', 100),
+                         ('sidewinder', 1000)]:
+        def run():
+            maze = levels.generate_maze_array(size, size, seed=0,
+                                              method=method)
+            levels.convert_to_thick_walls_array(maze)
+        runs = repeat if size * size <= 100 * 100 else max(3, repeat // 10)
+        results['maze/{}/{}x{}'.format(method, size, size)] = measure(run, runs)
+
+def bench_walls(game, results, repeat):
+    for walls in [100, 1000, 10000]:
+        start(game, arena_level(walls=walls))
+        player = game.player
+        player.reply = lambda result: None
+        start_pos = pg.math.Vector2(player.pos)
+
+        def reset():
+            player.pos = pg.math.Vector2(start_pos)
+
+        def move():
+            player.go_forward(100)
+            for i in range(10):
+                player.update()
+        results['collide/walls={}/10 updates'.format(walls)] = \
+            measure(move, repeat, setup=reset)
+
+        angles = list(range(0, 360, 45))
+        results['can_forward/walls={}/8 angles'.format(walls)] = \
+            measure(lambda: player.free_distance(10, angles), repeat)
+        results['scan/walls={}/360 beams'.format(walls)] = \
+            measure(lambda: player.scan(360, 10), repeat)
+
+def bench_status(game, results, repeat):
+    for items in [10, 100, 1000, 10000]:
+        start(game, arena_level(items=items, size=100))
+        results['status/items={}'.format(items)] = \
+            measure(lambda: game.status(game.player), repeat)
+
+def bench_agents(results, repeat):
+    for engine in [False, True]:
+        game = Game(headless=True, engine=engine)
+        for agents in [10, 100, 1000]:
+            start(game, arena_level(walls=1000, mobs=agents // 2,
+                                    players=agents // 2))
+            name = 'agents/{}/{} update'.format(
+                'numpy' if engine else 'python', agents)
+            results[name] = measure(game.update, repeat)
+
+def bench_tmx(game, results, repeat):
+    for name in ['level_1.tmx', 'level_2.tmx', 'level_3.tmx']:
+        path = os.path.join(game.map_folder, name)
+        results['tmx/compile/' + name] = measure(
+            lambda: CompiledMap.from_tiled(TiledMap(path)), max(3, repeat // 5))
+        load_compiled_map(path, game.level_cache_folder)
+        results['tmx/compiled load/' + name] = measure(
+            lambda: load_compiled_map(path, game.level_cache_folder),
+            max(3, repeat // 5))
+        compiled = load_compiled_map(path, game.level_cache_folder)
+        results['tmx/render/' + name] = measure(
+            lambda: render_chunks(compiled), max(3, repeat // 5))
+
+def render_chunks(compiled):
+    """Render every chunk of a fresh ChunkedMap of compiled."""
+    renderer = ChunkedMap(compiled.width, compiled.height,
+                          compiled.render_region)
+    cs = renderer.chunk_size
+    for row in range((compiled.height - 1) // cs + 1):
+        for col in range((compiled.width - 1) // cs + 1):
+            renderer.chunk(col, row)
+
+def bench_draw(results, repeat):
+    for dirty in [False, True]:
+        game = Game(dirty_rendering=dirty)
+        for level_cls in [levels.LevelOne, levels.LevelTwo, levels.LevelThree]:
+            start(game, level_cls)
+            name = 'draw/{}/{} frame'.format('dirty' if dirty else 'full',
+                                             level_cls.__name__)
+            results[name] = measure(game.draw, repeat, setup=game.update)
+
+SCENARIOS = ['maze', 'collide', 'can_forward', 'scan', 'status', 'agents', 'tmx',
+             'draw']
+
+def run(selected, repeat):
+    random.seed(0)
+    results = {}
+    game = Game(headless=True)
+    if 'maze' in selected:
+        bench_mazes(results, repeat)
+    if {'collide', 'can_forward', 'scan'} & set(selected):
+        bench_walls(game, results, repeat)
+    if 'status' in selected:
+        bench_status(game, results, repeat)
+    if 'agents' in selected:
+        bench_agents(results, repeat)
+    if 'tmx' in selected:
+        bench_tmx(game, results, repeat)
+    if 'draw' in selected:
+        bench_draw(results, repeat)
+    return {name: result for name, result in results.items()
+            if any(name.startswith(s) for s in selected)}
+
+def report(results, baseline, tolerance):
+    """Print the results next to the baseline; return the regressions."""
+    regressions = []
+    print('{:<44} {:>10} {:>10} {:>10} {:>7}'.format(
+        'scenario', 'median ms', 'p95 ms', 'base ms', 'ratio'))
+    for name, result in results.items():
+        line = '{:<44} {:>10.3f} {:>10.3f}'.format(
+            name, result['median_ms'], result['p95_ms'])
+        if name in baseline:
+            base = baseline[name]['median_ms']
+            ratio = result['median_ms'] / base if base else float('inf')
+            line += ' {:>10.3f} {:>6.2f}x'.format(base, ratio)
+            if ratio > tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='headless performance benchmarks')
+    parser.add_argument('--filter', nargs='+', default=SCENARIOS,
+                        choices=SCENARIOS, help='scenarios to run')
+    parser.add_argument('--repeat', type=int, default=30,
+                        help='timed runs per scenario')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='median slowdown vs. baseline counted as regression')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 if anything regressed')
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+    if args.check and regressions:
+        sys.exit(1)
@@ -0,0 +1,105 @@
+import argparse
+import csv
+import random
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+
+from game import Game
+import user_robots
+import levels
+
+METRICS = ['level', 'seed', 'success', 'sim_time', 'commands',
+           'collisions', 'wall_time']
+
+def run_episode(bot_name, level_name, seed, max_time):
+    """Play one headless episode and return its metrics.
+
+    The episode ends when the robot solves the level, when its worker
+    returns, or after max_time simulated seconds. The game runs in
+    lockstep with the robot, so all metrics but wall_time only depend
+    on the seed.
+    """
+    random.seed(seed)
+    game = Game(headless=True)
+    robot = getattr(user_robots, bot_name)(game)
+    game.set_level(getattr(levels, level_name))
+    game.new()
+    robot.run()
+
+    start = time.time()
+    success = False
+    while game.sim_time < max_time:
+        game.step()
+        if game.level.is_solved(game.player):
+            success = True
+            break
+        if not robot.channel.active:
+            break
+
+    return {'level': level_name,
+            'seed': seed,
+            'success': success,
+            'sim_time': game.sim_time,
+            'commands': robot.channel.command_count,
+            'collisions': game.player.collisions,
+            'wall_time': time.time() - start}
+
+def run_episode_args(args):
+    return run_episode(*args)
+
+def evaluate(bot_name, level_names, seeds, max_time, workers=None):
+    jobs = [(bot_name, level_name, seed, max_time)
+            for level_name in level_names
+            for seed in seeds]
+    # a fresh process per episode, robot threads don't outlive it
+    with Pool(workers or cpu_count(), maxtasksperchild=1) as pool:
+        return pool.map(run_episode_args, jobs, chunksize=1)
+
+def print_summary(results):
+    levels_seen = sorted(set(result['level'] for result in results))
+    for level_name in levels_seen:
+        rows = [result for result in results if result['level'] == level_name]
+        solved = sum(result['success'] for result in rows)
+        print('{}: solved {}/{}, mean sim time {:.2f} s, '
+              'mean commands {:.1f}, mean collisions {:.1f}, '
+              'wall time {:.2f} s'.format(
+                  level_name, solved, len(rows),
+                  sum(r['sim_time'] for r in rows) / len(rows),
+                  sum(r['commands'] for r in rows) / len(rows),
+                  sum(r['collisions'] for r in rows) / len(rows),
+                  sum(r['wall_time'] for r in rows)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='evaluate a bot on many headless episodes in parallel')
+    parser.add_argument('--bot', help='robot class name', default='TestRobot')
+    parser.add_argument('--level', help='level class name(s)', nargs='+',
+                        default=['LevelThree'])
+    parser.add_argument('--episodes', type=int, default=10,
+                        help='number of seeds per level')
+    parser.add_argument('--seed', type=int, default=0, help='first seed')
+    parser.add_argument('--max-time', type=float, default=120,
+                        help='simulated seconds per episode')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes (default: all cores)')
+    parser.add_argument('--output', help='write per-episode metrics to CSV')
+    args = parser.parse_args()
+    if not hasattr(user_robots, args.bot):
+        print('robot not found!')
+        sys.exit(1)
+    for level_name in args.level:
+        if not hasattr(levels, level_name):
+            print('level not found!')
+            sys.exit(1)
+
+    seeds = range(args.seed, args.seed + args.episodes)
+    results = evaluate(args.bot, args.level, seeds, args.max_time,
+                       args.workers)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS)
+            writer.writeheader()
+            writer.writerows(results)
+    print_summary(results)
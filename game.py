@@ -3,33 +3,78 @@ import argparse
 import os
 import sys
 
-from queue import Queue
+from queue import Empty
 from threading import Thread
-from time import sleep
+from time import sleep, perf_counter
 
-from copy import deepcopy
 import random
+from functools import partial
 
 from tilemap import *
 from settings import *
 from sprites import *
 from robot import *
+from profiler import Profiler
+from planning import Planner
 import user_robots
 import levels
 
 class Game:
-    def __init__(self):
-        pg.init()
-        pg.mixer.init()  # for sound
-        self.screen = pg.display.set_mode((WIDTH, HEIGHT))
-        pg.display.set_caption(TITLE)
+    def __init__(self, headless=False, dirty_rendering=False, engine=False,
+                 profile=False, profile_path=None, sim_dt=SIM_DT,
+                 lockstep=None, level_cache_folder=None):
+        self.headless = headless
+        # None: LEVEL_CACHE_FOLDER, '' disables the level cache
+        self.level_cache_folder = level_cache_folder
+        # headless runs wait for the robots, so results don't depend on
+        # how fast their threads happen to be scheduled
+        self.lockstep = headless if lockstep is None else lockstep
+        self.sim_dt = sim_dt
+        self.profiler = Profiler(enabled=profile or profile_path is not None)
+        self.profile_path = profile_path
+        self.draw_profile = False
+        self.profile_lines = []
+        self.profile_lines_time = 0
+        self.profile_rect = pg.Rect(0, 0, 0, 0)
+        self.dirty_rendering = dirty_rendering
+        self.engine = None
+        self.player_class = Player
+        self.mob_class = Mob
+        if engine:
+            # the batch engine module is only loaded when it is used
+            from physics import AgentEngine, EnginePlayer, EngineMob
+            self.engine = AgentEngine()
+            self.player_class = EnginePlayer
+            self.mob_class = EngineMob
+        if headless:
+            # no window, no sound, no fonts; a dummy 1x1 video mode is
+            # still needed so that images can be converted on load
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            pg.display.init()
+            self.screen = pg.display.set_mode((1, 1))
+        else:
+            pg.init()
+            pg.mixer.init()  # for sound
+            self.screen = pg.display.set_mode((WIDTH, HEIGHT))
+            pg.display.set_caption(TITLE)
+            pg.key.set_repeat(500, 100)
+            self.font_name = pg.font.match_font(FONT_NAME)
         self.clock = pg.time.Clock()
-        pg.key.set_repeat(500, 100)
-        self.font_name = pg.font.match_font(FONT_NAME)
+        self.dt = sim_dt
+        self.sim_time = 0
+        self.speed = 1
+        self.accumulator = 0
         self.load_data()
-        self.command_queue = Queue()
-        self.ready_for_command = True
+        self.channels = []
+        self.players = []
+        self.frame_count = 0
         self.draw_inventory = False
+        self.inventory_rect = pg.Rect(0, 0, 0, 0)
+        self.inventory_surf = None
+        self.inventory_key = None
+        self.drawn_sprites = None
+        self.fonts = {}
+        self.text_cache = {}
 
     def set_level(self, level_cls):
         self.level = level_cls(self)
@@ -48,12 +93,19 @@ class Game:
         self.assets_folder = assets_folder
         map_folder = os.path.join(assets_folder, 'maps')
         self.map_folder = map_folder
+        if self.level_cache_folder is None and LEVEL_CACHE:
+            self.level_cache_folder = LEVEL_CACHE_FOLDER
+        if self.level_cache_folder:
+            self.level_cache_folder = os.path.join(game_folder,
+                                                   self.level_cache_folder)
+        else:
+            self.level_cache_folder = None
         img_folder = os.path.join(assets_folder, 'images')
         self.img_folder = img_folder
 
-        # self.map = TiledMap(os.path.join(map_folder, 'level_3.tmx'))
-        # self.map_img = self.map.make_map()
-        # self.map_rect = self.map_img.get_rect()
+        # self.map = load_compiled_map(os.path.join(map_folder, 'level_3.tmx'))
+        # self.map_renderer = ChunkedMap(self.map.width, self.map.height,
+        #                                 self.map.render_region)
 
         self.player_img = self.load_img(
             os.path.join(img_folder, PLAYER_IMG),
@@ -67,6 +119,8 @@ class Game:
             os.path.join(img_folder, WALL_IMG),
             (TILESIZE, TILESIZE))
 
+        self.rot_cache = RotationCache()
+
         self.item_images = {}
         for item in ITEM_IMAGES:
             self.item_images[item] = \
@@ -76,12 +130,33 @@ class Game:
     def new(self):
         self.level.clear_sprites()
         self.level.new()
-        game.draw_debug = False
-        game.ready_for_command = True
+        self.wall_index = SpatialHash(self.walls)
+        self.occupancy = None
+        self.planner = None
+        if self.engine is not None:
+            self.engine.set_walls(self.walls)
+        self.spawn_players()
+        self.draw_debug = False
+        self.frame_count = 0
+        self.sim_time = 0
+        self.drawn_sprites = None
+
+    def get_font(self, size):
+        if size not in self.fonts:
+            self.fonts[size] = pg.font.Font(self.font_name, size)
+        return self.fonts[size]
+
+    def render_text(self, text, size, color):
+        key = (text, size, color)
+        if key not in self.text_cache:
+            if len(self.text_cache) >= TEXT_CACHE_SIZE:
+                self.text_cache.clear()
+            font = self.get_font(size)
+            self.text_cache[key] = font.render(text, True, color)
+        return self.text_cache[key]
 
     def draw_text(self, text, size, color, x, y, align='midtop'):
-        font = pg.font.Font(self.font_name, size)
-        text_surface = font.render(text, True, color)
+        text_surface = self.render_text(text, size, color)
         text_rect = text_surface.get_rect()
         if align == 'midtop':
             text_rect.midtop = (x, y)
@@ -91,6 +166,7 @@ class Game:
             text_rect.bottomleft = (x, y)
 
         self.screen.blit(text_surface, text_rect)
+        return text_rect
 
     def menu(self):
         self.screen.fill(BGCOLOR)
@@ -115,19 +191,71 @@ class Game:
                 if event.type == pg.KEYUP:
                     waiting = False
             
-    def run(self):
+    def run(self, max_steps=None, max_time=None):
+        """Run the main loop.
+
+        The simulation always advances in sim_dt steps: as fast as
+        possible in headless mode, otherwise at speed times real time.
+        max_steps / max_time (simulated seconds) can be used to stop
+        the loop.
+        """
         self.running = True
+        first_step = self.frame_count
         while self.running:
-            self.dt = self.clock.tick(FPS) / 1000.0
-            self.events()
-            self.update()
+            self.step()
+            steps = self.frame_count - first_step
+            if max_steps is not None and steps >= max_steps:
+                self.running = False
+            if max_time is not None and self.sim_time >= max_time:
+                self.running = False
+        self.export_profile()
+
+    def step(self):
+        """One drawn frame, or one simulation step when headless.
+
+        Windowed runs use a fixed timestep too: the (time warped) real
+        time since the last frame is worked off in sim_dt steps and the
+        frame is drawn once afterwards.
+        """
+        if self.headless:
+            self.sim_step()
+            return
+
+        elapsed = self.clock.tick(FPS) / 1000.0
+        with self.profiler.section('events'):
+            self.handle_keys()
+        self.accumulator += min(elapsed, MAX_FRAME_TIME) * self.speed
+        steps = 0
+        while self.accumulator >= self.sim_dt:
+            if steps == MAX_STEPS_PER_FRAME:
+                # too slow for this speed, don't build up a backlog
+                self.accumulator = 0
+                break
+            self.sim_step()
+            self.accumulator -= self.sim_dt
+            steps += 1
+        with self.profiler.section('draw'):
             self.draw()
 
+    def sim_step(self):
+        self.dt = self.sim_dt
+        self.sim_time += self.dt
+        self.frame_count += 1
+        with self.profiler.section('commands'):
+            self.handle_commands()
+        with self.profiler.section('update'):
+            self.update()
+
+    def set_speed(self, speed):
+        self.speed = speed
+        self.accumulator = 0
+
     def quit(self):
+        self.export_profile()
         pg.quit()
         sys.exit(0)
 
-    def events(self):
+    def handle_keys(self):
         for event in pg.event.get():
             # check for closing window
             if event.type == pg.QUIT:
@@ -139,48 +267,223 @@ class Game:
                     self.draw_debug = not self.draw_debug
                 if event.key == pg.K_i:
                     self.draw_inventory = not self.draw_inventory
-
-        commands = {'forward': self.player.go_forward,
-                    'turn': self.player.turn,
-                    'status': self.status,
-                    'pick': self.player.pick,
-                    'can_forward': self.player.can_go_forward,
-                    'drop': self.player.drop}
-        if self.ready_for_command:
-            try:
-                command = self.command_queue.get(block=False)
-                # print('command: {}'.format(command))
-                if command[0] in commands:
-                    self.ready_for_command = False
-                    try:
-                        commands[command[0]](*command[1:])
-                    except Exception as e:
-                        self.response_queue.put(repr(e))
-                        self.ready_for_command = True
-                else:
-                    self.response_queue.put("incorrect command")
-            except:
-                pass
-
-    def status(self):
+                if event.key in (pg.K_PLUS, pg.K_EQUALS, pg.K_KP_PLUS):
+                    faster = [s for s in TIME_WARP_SPEEDS if s > self.speed]
+                    if faster:
+                        self.set_speed(faster[0])
+                if event.key in (pg.K_MINUS, pg.K_KP_MINUS):
+                    slower = [s for s in TIME_WARP_SPEEDS if s < self.speed]
+                    if slower:
+                        self.set_speed(slower[-1])
+                if event.key in (pg.K_0, pg.K_KP0):
+                    self.set_speed(1)
+                if event.key == pg.K_p:
+                    self.draw_profile = not self.draw_profile
+                    if self.draw_profile:
+                        self.profiler.enabled = True
+
+    def connect(self):
+        """Open a command channel for a new robot.
+
+        Every channel gets its own Player sprite when a level starts
+        (or right away if a level is already running); the first one
+        controls game.player.
+        """
+        channel = Channel()
+        self.channels.append(channel)
+        if self.players:
+            self.spawn_player(channel)
+        return channel
+
+    def spawn_players(self):
+        self.players = [self.player]
+        self.player.channel = None
+        for channel in self.channels:
+            self.spawn_player(channel)
+
+    def spawn_player(self, channel):
+        if channel is self.channels[0]:
+            player = self.player
+        else:
+            x, y = self.level.robot_spawn_pos()
+            player = self.player_class(self, x, y)
+            self.players.append(player)
+        player.channel = channel
+        channel.player = player
+        channel.waiting_command = None
+        channel.command_count = 0
+
+    def query_commands(self, player):
+        """Commands answered immediately, within the current frame."""
+        return {'status': partial(self.status, player),
+                'pick': player.pick,
+                'can_forward': player.can_go_forward,
+                'free_distance': player.free_distance,
+                'scan': player.scan,
+                'path_to': partial(self.path_to, player),
+                'next_step': partial(self.next_step, player),
+                'drop': player.drop}
+
+    def motion_commands(self, player):
+        """Commands answered by the player once the motion is finished."""
+        return {'forward': player.go_forward,
+                'turn': player.turn,
+                'route': player.follow_route,
+                'wait': player.wait}
+
+    def run_query(self, queries, command):
+        try:
+            return queries[command[0]](*command[1:])
+        except Exception as e:
+            return repr(e)
+
+    def run_batch(self, player, commands):
+        queries = self.query_commands(player)
+        motions = self.motion_commands(player)
+        results = []
+        for command in commands:
+            if command[0] in queries:
+                results.append(self.run_query(queries, command))
+            elif command[0] in motions:
+                results.append("motion commands can't be batched")
+            else:
+                results.append("incorrect command")
+        return results
+
+    def handle_commands(self):
+        # rotate the starting channel so that no robot is always first
+        channels = self.channels
+        if not channels:
+            return
+        start = self.frame_count % len(channels)
+        for channel in channels[start:] + channels[:start]:
+            self.handle_channel(channel)
+
+    def handle_channel(self, channel):
+        """Serve queued (reply, command) pairs of one robot.
+
+        Queries are answered right away, even while the player is
+        moving; a motion command waits until the previous motion has
+        finished and at most one motion is started per frame. In
+        lockstep mode the simulation doesn't go on while a running robot
+        has no unanswered command, i.e. while it is thinking.
+        """
+        player = channel.player
+        if player is None or channel.closed:
+            channel.waiting_command = None
+            return
+        queries = self.query_commands(player)
+        motions = self.motion_commands(player)
+        for i in range(COMMANDS_PER_FRAME):
+            if self.lockstep:
+                channel.wait_for_robot()
+            if channel.waiting_command is not None:
+                if not player.ready_for_command:
+                    return
+                reply, command = channel.waiting_command
+                channel.waiting_command = None
+            else:
+                try:
+                    reply, command = channel.commands.get(block=False)
+                except Empty:
+                    return
+                channel.command_count += 1
+            # print('command: {}'.format(command))
+            if command[0] == 'batch':
+                with self.profiler.section('command/batch'):
+                    reply(self.run_batch(player, command[1]))
+            elif command[0] in queries:
+                with self.profiler.section('command/' + command[0]):
+                    reply(self.run_query(queries, command))
+            elif command[0] in motions:
+                if not player.ready_for_command:
+                    channel.waiting_command = (reply, command)
+                    return
+                player.ready_for_command = False
+                player.reply = reply
+                try:
+                    with self.profiler.section('command/' + command[0]):
+                        motions[command[0]](*command[1:])
+                except Exception as e:
+                    reply(repr(e))
+                    player.ready_for_command = True
+                return
+            else:
+                reply("incorrect command")
+
+    def occupancy_grid(self):
+        # built on the first scan, walls don't change during a level
+        if self.occupancy is None:
+            self.occupancy = OccupancyGrid(self.walls, self.map.width,
+                                           self.map.height)
+        return self.occupancy
+
+    def get_planner(self):
+        if self.planner is None:
+            self.planner = Planner(self.walls, self.map.width, self.map.height)
+        return self.planner
+
+    def tile_of(self, pos):
+        return int(pos[0] // TILESIZE), int(pos[1] // TILESIZE)
+
+    def goal_tile(self, player, goal):
+        """Tile of goal, an item type (the nearest such item) or a position."""
+        if isinstance(goal, str):
+            items = [item for item in self.items if item.type == goal]
+            if not items:
+                raise RuntimeError("Item not found")
+            item = min(items, key=lambda item:
+                       (item.pos - player.pos).length_squared())
+            return self.tile_of(item.pos)
+        return self.tile_of(goal)
+
+    def path_to(self, player, goal):
+        """Waypoints (tile centers) where a shortest path to goal turns,
+        ending at the goal tile."""
+        col, row = self.tile_of(player.pos)
+        waypoints = []
+        for rot, tiles in self.get_planner().runs((col, row),
+                                                  self.goal_tile(player, goal)):
+            step = vec(1, 0).rotate(-rot)
+            col += int(round(step.x)) * tiles
+            row += int(round(step.y)) * tiles
+            waypoints.append(((col + 0.5) * TILESIZE, (row + 0.5) * TILESIZE))
+        return waypoints
+
+    def next_step(self, player, goal):
+        """(angle, tiles) of the first straight run towards goal, None at the goal."""
+        runs = self.get_planner().runs(self.tile_of(player.pos),
+                                       self.goal_tile(player, goal))
+        return runs[0] if runs else None
+
+    def status(self, player):
         status = {}
-        status['player'] = self.player.status()
+        status['player'] = player.status()
         status['sense'] = {'on': [],
                            'near': []}
-        for item in self.items:
+        candidates = self.item_index.query_radius(
+            player.pos, ROBOT_SENSE_DIST + ITEM_BOB_RANGE)
+        for item in candidates:
             item_pos = item.rect.center
-            to_item = item_pos - self.player.pos
+            to_item = item_pos - player.pos
             if to_item.length_squared() < ROBOT_SENSE_DIST**2:
                 where = 'near'
-                if pg.sprite.spritecollide(self.player, [item], False, collide_hit_rect):
+                if collide_hit_rect(player, item):
                     where = 'on'
-                status['sense'][where].append({'type': deepcopy(item.type),
+                # item types are strings, no need to copy them
+                status['sense'][where].append({'type': item.type,
                                                'vec': to_item})
-        self.response_queue.put(status)
-        self.ready_for_command = True
+        return status
 
     def update(self):
-        self.all_sprites.update()
+        if self.engine is not None:
+            with self.profiler.section('update/engine'):
+                self.engine.step(self.dt, self.player.pos)
+                self.engine.update_agents(self.sim_time, self.player)
+        if self.profiler.enabled:
+            self.update_profiled()
+        else:
+            self.updated_sprites.update()
         self.camera.update(self.player)
         # Player hits item
         # hits = pg.sprite.spritecollide(self.player, self.items, False, collide_hit_rect)
@@ -188,12 +491,52 @@ class Game:
         #     if hit.type == 'apple':
         #         pass
 
+    def update_profiled(self):
+        """updated_sprites.update() with the time spent per sprite class."""
+        times = {}
+        for sprite in self.updated_sprites.sprites():
+            start = perf_counter()
+            sprite.update()
+            name = type(sprite).__name__
+            times[name] = times.get(name, 0) + perf_counter() - start
+        for name, seconds in times.items():
+            self.profiler.record('update/' + name, seconds)
+
+    def export_profile(self):
+        if self.profile_path is not None:
+            self.profiler.export(self.profile_path)
+
+    def draw_profile_overlay(self):
+        # refresh the numbers twice a second, not every frame
+        if self.sim_time - self.profile_lines_time > 0.5:
+            self.profile_lines = self.profiler.overlay_lines()
+            self.profile_lines_time = self.sim_time
+        rect = pg.Rect(0, 0, 0, 0)
+        for i, line in enumerate(self.profile_lines):
+            line_rect = self.draw_text(line, 14, WHITE, 10, 10 + 16 * i,
+                                       align='topleft')
+            rect = line_rect if i == 0 else rect.union(line_rect)
+        return rect
+
     def draw(self):
-        pg.display.set_caption('fps: {:.2f}'.format(self.clock.get_fps()))
-        self.screen.fill(BGCOLOR)
-        self.screen.blit(self.map_img, self.camera.apply_rect(self.map_rect))
+        pg.display.set_caption('fps: {:.2f}  speed: x{}'.format(
+            self.clock.get_fps(), self.speed))
+        if self.dirty_rendering:
+            self.draw_dirty()
+        else:
+            self.draw_scene()
+            pg.display.flip()
+
+    def draw_scene(self, area=None):
+        """Draw the whole frame, or only what overlaps the screen rect area."""
+        self.screen.fill(BGCOLOR, area)
+        self.map_renderer.draw(self.screen, self.camera, area)
         # self.draw_grid()
-        for sprite in self.all_sprites:
+        full = area is None
+        if full:
+            area = self.screen.get_rect()
+        view = self.camera.to_world(area)
+        for sprite in self.visible_sprites(view):
             self.screen.blit(sprite.image, self.camera.apply(sprite))
             if hasattr(sprite, 'hit_rect'):
                 rect = sprite.hit_rect
@@ -204,49 +547,128 @@ class Game:
                              self.camera.apply_rect(rect), 1)
 
         if self.draw_debug:
-            for wall in self.walls:
+            for wall in self.wall_index.query(view):
                 pg.draw.rect(self.screen, WHITE,
                              self.camera.apply_rect(wall.rect), 1)
 
+        if self.draw_profile:
+            if full or area.colliderect(self.profile_rect):
+                self.profile_rect = self.draw_profile_overlay()
+
         # draw inventory
         if self.draw_inventory:
-            inv_height = TILESIZE
-            inv_width = TILESIZE
-            inv_in_margin = 5
-            inv_out_margin = TILESIZE
-
-            inv_len = self.player.inventory_size
-            inv_H = inv_height
-            inv_W = inv_len * inv_width + (inv_len - 1) * inv_in_margin
-            inv_TL = (WIDTH - inv_W - inv_out_margin,
-                      HEIGHT - inv_out_margin - inv_H)
-
-            self.draw_text("INVENTORY", TILESIZE // 2, WHITE,
-                           inv_TL[0], inv_TL[1],
-                           align='bottomleft')
-            inv_surf = pg.Surface((inv_W, inv_H))
-            inv_surf.set_colorkey(BLACK)
-            # inv_surf.fill(DARKGREY)
-
-            for inv_place in range(inv_len):
-                rect = pg.Rect(inv_place * (inv_width + inv_in_margin),
-                               0,
-                               inv_width,
-                               inv_height)
-                lw = 1
-                if inv_place < len(self.player.inventory):
-                    # pg.draw.rect(inv_surf,
-                    #              LIGHTGREY,
-                    #              rect, 0)
-                    inv_surf.blit(self.item_images[self.player.inventory[inv_place]],
-                                  rect)
-
-                pg.draw.rect(inv_surf,
-                             WHITE,
-                             rect, 1)
-            self.screen.blit(inv_surf, inv_TL)
-            
-        pg.display.flip()
+            if full or area.colliderect(self.inventory_rect):
+                self.inventory_rect = self.draw_inventory_panel()
+
+    def visible_sprites(self, view):
+        """Sprites overlapping the world rect view, in layer order.
+
+        Candidates come from the sprite index (walls, items, players and
+        mobs) and from the batch engine for the agents it steps.
+        """
+        candidates = self.sprite_index.query(view.inflate(0, 2 * ITEM_BOB_RANGE))
+        if self.engine is not None:
+            candidates.extend(self.engine.query(view))
+        visible = [sprite for sprite in candidates
+                   if sprite.alive() and view.colliderect(sprite.rect)]
+        visible.sort(key=self.all_sprites.get_layer_of_sprite)
+        return visible
+
+    def draw_dirty(self):
+        """Redraw and push only the screen regions that changed.
+
+        Falls back to a full redraw when the camera scrolled, the level
+        was restarted, the debug view is on or the inventory overlay
+        changed.
+        """
+        view = self.camera.to_world(self.screen.get_rect())
+        drawn = {sprite: (self.camera.apply(sprite), sprite.image)
+                 for sprite in self.visible_sprites(view)}
+        camera_pos = self.camera.camera.topleft
+        overlay = (self.draw_inventory, tuple(self.player.inventory),
+                   self.draw_profile, tuple(self.profile_lines))
+
+        if self.drawn_sprites is None or self.draw_debug or \
+           camera_pos != self.drawn_camera or overlay != self.drawn_overlay:
+            self.draw_scene()
+            pg.display.flip()
+        else:
+            dirty = []
+            for sprite, (rect, image) in drawn.items():
+                old = self.drawn_sprites.get(sprite)
+                if old is None:
+                    dirty.append(rect)
+                elif old[0] != rect or old[1] is not image:
+                    dirty.append(rect)
+                    dirty.append(old[0])
+            for sprite, (rect, image) in self.drawn_sprites.items():
+                if sprite not in drawn:
+                    dirty.append(rect)
+
+            screen_rect = self.screen.get_rect()
+            dirty = [rect.clip(screen_rect) for rect in dirty]
+            dirty = [rect for rect in dirty if rect.width and rect.height]
+            for rect in dirty:
+                self.screen.set_clip(rect)
+                self.draw_scene(rect)
+            self.screen.set_clip(None)
+            if dirty:
+                pg.display.update(dirty)
+
+        self.drawn_sprites = drawn
+        self.drawn_camera = camera_pos
+        self.drawn_overlay = overlay
+
+    def draw_inventory_panel(self):
+        inv_out_margin = TILESIZE
+        inv_surf = self.get_inventory_surf()
+        inv_W, inv_H = inv_surf.get_size()
+        inv_TL = (WIDTH - inv_W - inv_out_margin,
+                  HEIGHT - inv_out_margin - inv_H)
+
+        text_rect = self.draw_text("INVENTORY", TILESIZE // 2, WHITE,
+                                   inv_TL[0], inv_TL[1],
+                                   align='bottomleft')
+        inv_rect = self.screen.blit(inv_surf, inv_TL)
+        return inv_rect.union(text_rect)
+
+    def get_inventory_surf(self):
+        """Inventory slots surface, rebuilt only when the inventory changes."""
+        key = (self.player.inventory_size, tuple(self.player.inventory))
+        if key == self.inventory_key:
+            return self.inventory_surf
+
+        inv_height = TILESIZE
+        inv_width = TILESIZE
+        inv_in_margin = 5
+
+        inv_len = self.player.inventory_size
+        inv_H = inv_height
+        inv_W = inv_len * inv_width + (inv_len - 1) * inv_in_margin
+        inv_surf = pg.Surface((inv_W, inv_H))
+        inv_surf.set_colorkey(BLACK)
+        # inv_surf.fill(DARKGREY)
+
+        for inv_place in range(inv_len):
+            rect = pg.Rect(inv_place * (inv_width + inv_in_margin),
+                           0,
+                           inv_width,
+                           inv_height)
+            lw = 1
+            if inv_place < len(self.player.inventory):
+                # pg.draw.rect(inv_surf,
+                #              LIGHTGREY,
+                #              rect, 0)
+                inv_surf.blit(self.item_images[self.player.inventory[inv_place]],
+                              rect)
+
+            pg.draw.rect(inv_surf,
+                         WHITE,
+                         rect, 1)
+
+        self.inventory_surf = inv_surf
+        self.inventory_key = key
+        return inv_surf
 
     def draw_grid(self):
         for x in range(0, WIDTH, TILESIZE):
@@ -259,6 +681,27 @@ if __name__ == '__main__':
     parser.add_argument('--manual', action='store_true')
     parser.add_argument('--bot', help='robot class name', default='TestRobot')
     parser.add_argument('--level', help='level class name', default='LevelOne')
+    parser.add_argument('--robots', type=int, default=1,
+                        help='number of bot instances in the level')
+    parser.add_argument('--headless', action='store_true',
+                        help='no window, simulate as fast as possible')
+    parser.add_argument('--dirty', action='store_true',
+                        help='redraw only the changed parts of the screen')
+    parser.add_argument('--numpy', action='store_true',
+                        help='step robots and mobs with the numpy engine')
+    parser.add_argument('--profile', action='store_true',
+                        help='collect timings (overlay: p)')
+    parser.add_argument('--profile-out', default=None,
+                        help='write timings to this JSON/CSV file on exit')
+    parser.add_argument('--speed', type=int, default=1,
+                        choices=TIME_WARP_SPEEDS,
+                        help='simulation speed of windowed runs (keys +, -, 0)')
+    parser.add_argument('--dt', type=float, default=SIM_DT,
+                        help='simulation timestep in seconds')
+    parser.add_argument('--max-steps', type=int, default=None,
+                        help='stop after this many simulation steps')
+    parser.add_argument('--max-time', type=float, default=None,
+                        help='stop after this many simulated seconds')
     args = parser.parse_args()
     if not hasattr(user_robots, args.bot):
         print('robot not found!')
@@ -267,14 +710,19 @@ if __name__ == '__main__':
         print('level not found!')
         sys.exit(1)
 
-    game = Game()
-    game.menu()
+    game = Game(headless=args.headless, dirty_rendering=args.dirty,
+                engine=args.numpy, profile=args.profile,
+                profile_path=args.profile_out, sim_dt=args.dt)
+    game.set_speed(args.speed)
+    if not args.headless:
+        game.menu()
     if not args.manual:
         robot_class = getattr(user_robots, args.bot)
-        robot = robot_class(game)
-        robot.run()
+        for i in range(args.robots):
+            robot = robot_class(game)
+            robot.run()
 
     level_class = getattr(levels, args.level)
     game.set_level(level_class)
     game.new()
-    game.run()
+    game.run(max_steps=args.max_steps, max_time=args.max_time)
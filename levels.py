@@ -2,7 +2,10 @@ from __future__ import print_function
 
 import os
 import random
-from tilemap import Map, TiledMap, Camera, TileSet
+
+import numpy as np
+from tilemap import Map, Camera, TileSet, SpatialHash, ChunkedMap, \
+    collide_hit_rect, load_compiled_map
 import pygame as pg
 vec = pg.math.Vector2
 from sprites import *
@@ -10,10 +13,15 @@ from sprites import *
 def is_between(x, low, high):
     return x >= 0 and x <= high
 
-def carve_maze(row, col, grid):
-    N, S, E, W = 1, 2, 4, 8
-    directions = [N, S, E, W]
-    random.shuffle(directions)
+N, S, E, W = 1, 2, 4, 8
+
+def carve_maze(row, col, grid, rng=random):
+    """Carve a perfect maze into grid by depth-first search from (row, col).
+
+    Iterative version of the recursive backtracker: every stack entry
+    keeps the directions of its cell that are still to be tried, so the
+    maze size is not limited by the recursion limit.
+    """
     deltas = {N: (-1, 0),
               S: (1, 0),
               W: (0, -1),
@@ -23,7 +31,18 @@ def carve_maze(row, col, grid):
     height = len(grid)
     width = len(grid[0])
 
-    for dir in directions:
+    def shuffled():
+        directions = [N, S, E, W]
+        rng.shuffle(directions)
+        return directions
+
+    stack = [(row, col, shuffled())]
+    while stack:
+        row, col, directions = stack[-1]
+        if not directions:
+            stack.pop()
+            continue
+        dir = directions.pop(0)
         new_r = row + deltas[dir][0]
         new_c = col + deltas[dir][1]
 
@@ -32,13 +51,90 @@ def carve_maze(row, col, grid):
            grid[new_r][new_c] == 0:
             grid[row][col] |= dir
             grid[new_r][new_c] |= reverse[dir]
-            carve_maze(new_r, new_c, grid)
-    
+            stack.append((new_r, new_c, shuffled()))
 
-def generate_maze(height, width):
+def generate_maze(height, width, seed=None):
+    rng = random if seed is None else random.Random(seed)
     maze = [[0 for c in range(width)]
             for r in range(height)]
-    carve_maze(height // 2, width // 2, maze)
+    carve_maze(height // 2, width // 2, maze, rng)
+    return maze
+
+def backtrack_maze_array(height, width, rng):
+    """Recursive backtracker on a flat bytearray, without recursion.
+
+    Stepping to a random unvisited neighbour is equivalent to trying the
+    neighbours in shuffled order as carve_maze does.
+    """
+    size = height * width
+    maze = bytearray(size)
+    visited = bytearray(size)
+    start = (height // 2) * width + width // 2
+    visited[start] = 1
+    stack = [start]
+    while stack:
+        cell = stack[-1]
+        col = cell % width
+        options = []
+        if cell >= width and not visited[cell - width]:
+            options.append((cell - width, N, S))
+        if cell + width < size and not visited[cell + width]:
+            options.append((cell + width, S, N))
+        if col + 1 < width and not visited[cell + 1]:
+            options.append((cell + 1, E, W))
+        if col > 0 and not visited[cell - 1]:
+            options.append((cell - 1, W, E))
+        if not options:
+            stack.pop()
+            continue
+        new, dir, back = rng.choice(options)
+        maze[cell] |= dir
+        maze[new] |= back
+        visited[new] = 1
+        stack.append(new)
+    return np.frombuffer(bytes(maze), dtype=np.uint8).reshape(height, width)
+
+def generate_maze_array(height, width, seed=None, method='auto'):
+    """Maze as a (height, width) uint8 array of N/S/E/W passage bits.
+
+    'backtracker' gives the same long winding corridors as
+    generate_maze (about 2 s for 1000x1000 cells); 'sidewinder' is
+    fully vectorized and meant for very large levels (1000x1000 cells in
+    about 0.1 s), at the price of a straight corridor along the top row.
+    'auto' picks the backtracker up to MAZE_BACKTRACKER_CELLS cells.
+    """
+    if method == 'auto':
+        if height * width <= MAZE_BACKTRACKER_CELLS:
+            method = 'backtracker'
+        else:
+            method = 'sidewinder'
+    if method == 'backtracker':
+        return backtrack_maze_array(height, width,
+                                    random.Random(seed))
+    if method != 'sidewinder':
+        raise ValueError("unknown maze method: {}".format(method))
+
+    rng = np.random.RandomState(seed)
+    maze = np.zeros((height, width), dtype=np.uint8)
+
+    # carve east with probability 1/2 (always on the top row), never
+    # out of the last column
+    east = rng.randint(2, size=(height, width)).astype(bool)
+    east[0] = True
+    east[:, -1] = False
+    maze[:, :-1][east[:, :-1]] |= E
+    maze[:, 1:][east[:, :-1]] |= W
+
+    # every run of cells joined east (below the top row) gets one
+    # passage north from a random cell of the run
+    ends = np.flatnonzero(~east[1:].ravel())
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    chosen = starts + (rng.random_sample(len(starts)) *
+                       (ends - starts + 1)).astype(np.int64)
+    rows = chosen // width + 1
+    cols = chosen % width
+    maze[rows, cols] |= N
+    maze[rows - 1, cols] |= S
     return maze
 
 def convert_to_thick_walls(maze):
@@ -46,8 +142,6 @@ def convert_to_thick_walls(maze):
     h = (2 * h_thin) + 1
     w = (2 * w_thin) + 1
 
-    N, S, E, W = 1, 2, 4, 8
-
     new = [[0 for col in range(w)]
            for row in range(h)]
     for row in range(h):
@@ -70,6 +164,55 @@ def convert_to_thick_walls(maze):
                 
     return new
 
+def convert_to_thick_walls_array(maze):
+    """Vectorized convert_to_thick_walls for a maze array; 1 is wall."""
+    h_thin, w_thin = maze.shape
+    new = np.ones((2 * h_thin + 1, 2 * w_thin + 1), dtype=np.uint8)
+    new[1::2, 1::2] = 0
+    new[1::2, 2:-1:2][(maze[:, :-1] & E) != 0] = 0
+    new[2:-1:2, 1::2][(maze[:-1, :] & S) != 0] = 0
+    return new
+
+def merge_wall_cells(grid):
+    """Cover the wall (non-zero) cells of grid with few rectangles.
+
+    Greedy meshing: starting from each uncovered wall cell, grow a run
+    to the right, then grow it down while the whole run below is wall.
+    Row by row, the runs are the uncovered stretches of wall and a run
+    can grow down as far as its shortest column of wall cells, so every
+    row is handled with a few array operations.
+    Returns a list of (row, col, height, width) tuples.
+    """
+    grid = np.asarray(grid, dtype=bool)
+    h, w = grid.shape
+    # down[r, c]: consecutive wall cells from (r, c) downwards
+    down = np.zeros((h + 1, w + 1), dtype=np.int64)
+    for row in range(h - 1, -1, -1):
+        down[row, :w] = (down[row + 1, :w] + 1) * grid[row]
+    # cover_end[c]: first row not covered by the last rect over column c
+    cover_end = np.zeros(w, dtype=np.int64)
+    padded = np.zeros(w + 2, dtype=np.int8)
+
+    rects = []
+    for row in range(h):
+        free = grid[row] & (cover_end <= row)
+        padded[1:-1] = free
+        edges = np.diff(padded)
+        starts = np.flatnonzero(edges == 1)
+        if not len(starts):
+            continue
+        ends = np.flatnonzero(edges == -1)
+        widths = ends - starts
+        # minimum of down over [start, end) of every run
+        bounds = np.empty(2 * len(starts), dtype=np.int64)
+        bounds[0::2] = starts
+        bounds[1::2] = ends
+        heights = np.minimum.reduceat(down[row], bounds)[0::2]
+        cover_end[free] = row + np.repeat(heights, widths)
+        rects.extend(zip([row] * len(starts), starts.tolist(),
+                         heights.tolist(), widths.tolist()))
+    return rects
+
 class Level:
     def __init__(self, game):
         self.game = game
@@ -78,39 +221,54 @@ class Level:
     def new(self):
         pass
 
+    def is_solved(self, player):
+        """Whether player has completed the level; levels without a goal never are."""
+        return False
+
+    def robot_spawn_pos(self):
+        """Where additional robots start; next to the first one by default."""
+        return self.game.player.pos.x, self.game.player.pos.y
+
     def make_map_from_file(self, file):
-        self.map = TiledMap(os.path.join(self.map_folder, file))
+        self.map = load_compiled_map(os.path.join(self.map_folder, file),
+                                     self.game.level_cache_folder)
         self.game.map = self.map
-        self.game.map_img = self.map.make_map()
-        self.game.map_rect = self.game.map_img.get_rect()
+        self.game.map_renderer = ChunkedMap(self.map.width, self.map.height,
+                                            self.map.render_region)
 
     def clear_sprites(self):
         game = self.game
         game.camera = Camera(self.map.width, self.map.height)
         game.all_sprites = pg.sprite.LayeredUpdates()
+        # the sprites with a per-frame update(), in drawing order; engine
+        # agents are stepped in bulk instead
+        game.updated_sprites = pg.sprite.LayeredUpdates()
         game.walls = pg.sprite.Group()
         game.mobs = pg.sprite.Group()
         game.items = pg.sprite.Group()
+        game.item_index = SpatialHash()
+        # all_sprites but the engine agents, for drawing only what is in view
+        game.sprite_index = SpatialHash()
+        if game.engine is not None:
+            game.engine.clear()
 
     def spawn_tmx_objects(self):        
         game = self.game
-        for tile_object in self.map.tmxdata.objects:
+        for tile_object in self.map.objects:
             object_center = vec(tile_object.x + tile_object.width / 2,
                                 tile_object.y + tile_object.height / 2)
             if tile_object.name == 'player':
-                game.player = Player(game, object_center.x, object_center.y)
-            if tile_object.name == 'wall':
-                Obstacle(game,
-                         tile_object.x,
-                         tile_object.y,
-                         tile_object.width,
-                         tile_object.height)
+                game.player = game.player_class(game, object_center.x, object_center.y)
             if tile_object.name == 'mob':
-                Mob(game, object_center.x, object_center.y)
+                game.mob_class(game, object_center.x, object_center.y)
 
             if tile_object.name in ['apple']:
                 Item(game, object_center, tile_object.name)
 
+        # walls are merged when the level is compiled
+        for x, y, w, h in self.map.walls:
+            Obstacle(game, x, y, w, h)
+
 class LevelOne(Level):
     def make_map(self):
         self.make_map_from_file('level_1.tmx')
@@ -126,64 +284,87 @@ class LevelTwo(Level):
         self.spawn_tmx_objects()
  
 class LevelThree(Level):
+    maze_width = MAZE_WIDTH
+    maze_height = MAZE_HEIGHT
+    maze_method = MAZE_METHOD
+
     def make_map(self):
         tileset_path = os.path.join(self.game.map_folder, 'RPGpack_sheet.png')
         tileset = TileSet(tileset_path, tilesize=32)
         grass_tile_ids = [41, 42, 43, 44, 81, 82, 83, 84]
-        grass_tiles = [tileset[id] for id in grass_tile_ids]
+        grass_tiles = tileset.get_many(grass_tile_ids)
 
         wall_tile_ids = [267, 268, 269, 270]
-        wall_tiles = [tileset[id] for id in wall_tile_ids]
+        wall_tiles = tileset.get_many(wall_tile_ids)
 
-        W = 10
-        H = 10
-        map_data = generate_maze(H, W)
-        map_data = convert_to_thick_walls(map_data)
+        seed = random.randrange(2**32)
+        map_data = generate_maze_array(self.maze_height, self.maze_width,
+                                       seed=seed, method=self.maze_method)
+        map_data = convert_to_thick_walls_array(map_data)
 
-        H = len(map_data)
-        W = len(map_data[0])
+        H, W = map_data.shape
 
         self.map = Map(W, H)
         self.game.map = self.map
 
-        empty_cells = []
-        wall_cells = []
-        map_img = pg.Surface((self.map.width, self.map.height))
-        for r in range(H):
-            for c in range(W):
-                if map_data[r][c] == 0:
-                    tile = random.choice(grass_tiles)
-                    empty_cells.append((r, c))
-                else:
-                    tile = random.choice(wall_tiles)
-                    wall_cells.append((r, c))
- 
-                map_img.blit(tile, (c * TILESIZE,
-                                    r * TILESIZE))
+        # tile number of every cell: grass tiles first, then wall tiles
+        tiles = grass_tiles + wall_tiles
+        rng = np.random.RandomState(seed)
+        tile_map = np.where(map_data == 0,
+                            rng.randint(len(grass_tiles), size=(H, W)),
+                            len(grass_tiles) + rng.randint(len(wall_tiles),
+                                                           size=(H, W)))
 
-        self.player_init_pos = random.choice(empty_cells)
-        self.goal_pos = random.choice(empty_cells)
+        self.tiles = tiles
+        self.tile_map = tile_map
+        self.game.map_renderer = ChunkedMap(self.map.width, self.map.height,
+                                            self.render_region)
+
+        self.empty_cells = np.argwhere(map_data == 0)
+        wall_cells = np.argwhere(map_data != 0)
+        self.player_init_pos = self.random_empty_cell()
+        self.goal_pos = self.random_empty_cell()
 
-        self.game.map_img = map_img
-        self.game.map_rect = map_img.get_rect()
         self.wall_cells = wall_cells
+        self.wall_rects = merge_wall_cells(map_data)
+
+    def render_region(self, surface, rect):
+        cols = slice(rect.left // TILESIZE, (rect.right - 1) // TILESIZE + 1)
+        rows = slice(rect.top // TILESIZE, (rect.bottom - 1) // TILESIZE + 1)
+        for r, row in enumerate(self.tile_map[rows, cols].tolist(),
+                                rows.start):
+            for c, tile in enumerate(row, cols.start):
+                surface.blit(self.tiles[tile], (c * TILESIZE - rect.x,
+                                                r * TILESIZE - rect.y))
+
+    def random_empty_cell(self):
+        index = random.randrange(len(self.empty_cells))
+        return tuple(self.empty_cells[index].tolist())
+
+    def robot_spawn_pos(self):
+        row, col = self.random_empty_cell()
+        return (col * TILESIZE + TILESIZE / 2,
+                row * TILESIZE + TILESIZE / 2)
 
     def new(self):
         game = self.game
         pos = self.player_init_pos
         x = pos[1] * TILESIZE + TILESIZE / 2
         y = pos[0] * TILESIZE + TILESIZE / 2
-        game.player = Player(game, x, y)
+        game.player = game.player_class(game, x, y)
 
-        for coords in self.wall_cells:
+        for row, col, height, width in self.wall_rects:
             Obstacle(game,
-                     coords[1] * TILESIZE,
-                     coords[0] * TILESIZE,
-                     TILESIZE,
-                     TILESIZE)
+                     col * TILESIZE,
+                     row * TILESIZE,
+                     width * TILESIZE,
+                     height * TILESIZE)
 
         pos = self.goal_pos
         x = pos[1] * TILESIZE + TILESIZE / 2
         y = pos[0] * TILESIZE + TILESIZE / 2
-        Item(game, vec(x, y), 'goal',
-             pickable=False, bobbing=False)
+        self.goal_item = Item(game, vec(x, y), 'goal',
+                              pickable=False, bobbing=False)
+
+    def is_solved(self, player):
+        return collide_hit_rect(player, self.goal_item)
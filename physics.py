@@ -0,0 +1,396 @@
+"""Optional NumPy engine that steps all players and mobs in batch.
+
+The engine keeps positions, velocities, rotations and goals of every
+agent in flat arrays (struct of arrays). EnginePlayer and EngineMob are
+drop-in replacements for Player and Mob whose state lives in the engine.
+They are not updated one by one: after each step update_agents() only
+touches the agents with a finished motion or wait, and images and rects
+are rebuilt when they are read (e.g. for the agents in view). Enable it
+with Game(engine=True) / game.py --numpy. Hit rects are rounded the way
+pg.Rect rounds, so engine runs follow the same paths as pure Python runs.
+"""
+import math
+
+import numpy as np
+import pygame as pg
+
+from settings import *
+from sprites import Player, Mob
+
+vec = pg.math.Vector2
+
+IDLE = 0
+HIT_WALL = 1
+GOAL_REACHED = 2
+ANGLE_GOAL_REACHED = 3
+
+EVENT_REPLIES = {HIT_WALL: "hit a wall",
+                 GOAL_REACHED: "goal reached",
+                 ANGLE_GOAL_REACHED: "angle goal reached"}
+
+def rect_coord(x):
+    """Round like pg.Rect does for float coordinates (half away from zero)."""
+    return np.where(x >= 0, np.floor(x + 0.5), np.ceil(x - 0.5)).astype(np.int64)
+
+class AgentEngine:
+    def __init__(self, capacity=64):
+        self.allocate(capacity)
+        self.set_walls([])
+
+    def allocate(self, capacity):
+        self.count = 0
+        self.agents = []
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.goal = np.zeros((capacity, 2))
+        self.size = np.zeros((capacity, 2), dtype=np.int64)
+        self.rot = np.zeros(capacity)
+        self.rot_speed = np.zeros(capacity)
+        self.angle_goal = np.zeros(capacity)
+        self.goal_mode = np.zeros(capacity, dtype=bool)
+        self.angle_goal_mode = np.zeros(capacity, dtype=bool)
+        self.is_mob = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.event = np.zeros(capacity, dtype=np.int8)
+        self.collided = np.zeros(capacity, dtype=bool)
+        self.colliding = np.zeros(capacity, dtype=bool)
+        self.collisions = np.zeros(capacity, dtype=np.int64)
+        # NaN while not waiting
+        self.wait_until = np.full(capacity, np.nan)
+        # half diagonal of the agent's image, bounds any rotation of it
+        self.extent = np.zeros(capacity)
+
+    def grow(self):
+        capacity = 2 * len(self.alive)
+        for name in ['pos', 'vel', 'goal', 'size', 'rot', 'rot_speed',
+                     'angle_goal', 'goal_mode', 'angle_goal_mode',
+                     'is_mob', 'alive', 'event', 'collided', 'colliding',
+                     'collisions', 'wait_until', 'extent']:
+            old = getattr(self, name)
+            new = np.full((capacity, ) + old.shape[1:],
+                          np.nan if name == 'wait_until' else 0,
+                          dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def clear(self):
+        self.allocate(len(self.alive))
+
+    def add(self, agent, size, image_size, is_mob=False):
+        """Reserve a slot for a new agent sprite with a (w, h) hit rect
+        and an image of image_size."""
+        if self.count == len(self.alive):
+            self.grow()
+        index = self.count
+        self.count += 1
+        self.agents.append(agent)
+        self.size[index] = size
+        self.extent[index] = math.ceil(math.hypot(*image_size) / 2) + 1
+        self.is_mob[index] = is_mob
+        self.alive[index] = True
+        return index
+
+    def remove(self, index):
+        self.alive[index] = False
+        self.goal_mode[index] = False
+        self.angle_goal_mode[index] = False
+
+    def set_walls(self, walls):
+        """Bucket the (static) wall rects into a grid of TILESIZE cells.
+
+        cell_walls[row, col] holds the indices of the walls overlapping
+        the cell, padded with -1.
+        """
+        rects = [wall.rect for wall in walls]
+        self.walls = np.array([(r.left, r.top, r.right, r.bottom)
+                               for r in rects], dtype=np.int64).reshape(-1, 4)
+        if not rects:
+            self.cell_walls = np.full((1, 1, 1), -1, dtype=np.int64)
+            return
+
+        cs = TILESIZE
+        cols = max(r.right for r in rects) // cs + 1
+        rows = max(r.bottom for r in rects) // cs + 1
+        buckets = {}
+        for i, r in enumerate(rects):
+            for row in range(r.top // cs, (r.bottom - 1) // cs + 1):
+                for col in range(r.left // cs, (r.right - 1) // cs + 1):
+                    buckets.setdefault((row, col), []).append(i)
+        depth = max(len(bucket) for bucket in buckets.values())
+        cell_walls = np.full((rows, cols, depth), -1, dtype=np.int64)
+        for (row, col), bucket in buckets.items():
+            if row >= 0 and col >= 0:
+                cell_walls[row, col, :len(bucket)] = bucket
+        self.cell_walls = cell_walls
+
+    def first_wall_hit(self, left, top, width, height):
+        """Index of the first wall overlapping each rect, or -1."""
+        cs = TILESIZE
+        rows, cols, depth = self.cell_walls.shape
+        span_x = int(width.max()) // cs + 2 if len(width) else 1
+        span_y = int(height.max()) // cs + 2 if len(height) else 1
+        col0 = left // cs
+        row0 = top // cs
+
+        candidates = []
+        for dr in range(span_y):
+            for dc in range(span_x):
+                row = row0 + dr
+                col = col0 + dc
+                inside = (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+                cell = self.cell_walls[np.clip(row, 0, rows - 1),
+                                       np.clip(col, 0, cols - 1)]
+                candidates.append(np.where(inside[:, None], cell, -1))
+        candidates = np.concatenate(candidates, axis=1)
+
+        wall = self.walls[np.maximum(candidates, 0)]
+        right = (left + width)[:, None]
+        bottom = (top + height)[:, None]
+        overlap = (candidates >= 0) & \
+                  (left[:, None] < wall[..., 2]) & (right > wall[..., 0]) & \
+                  (top[:, None] < wall[..., 3]) & (bottom > wall[..., 1])
+
+        big = len(self.walls)
+        first = np.where(overlap, candidates, big).min(axis=1)
+        return np.where(first < big, first, -1)
+
+    def collide_axis(self, idx, axis):
+        """Vectorized collide_with_walls for agents idx along one axis."""
+        pos = self.pos[idx]
+        size = self.size[idx]
+        left = rect_coord(pos[:, 0]) - size[:, 0] // 2
+        top = rect_coord(pos[:, 1]) - size[:, 1] // 2
+        first = self.first_wall_hit(left, top, size[:, 0], size[:, 1])
+        hit = first >= 0
+        if not hit.any():
+            return hit
+
+        wall = self.walls[first[hit]]
+        half = size[hit, axis] / 2
+        vel = self.vel[idx[hit], axis]
+        coord = self.pos[idx[hit], axis]
+        coord = np.where(vel > 0, wall[:, axis] - half, coord)
+        coord = np.where(vel < 0, wall[:, axis + 2] + half, coord)
+        self.pos[idx[hit], axis] = coord
+        self.vel[idx[hit], axis] = 0
+        return hit
+
+    def step(self, dt, target):
+        """Advance all agents by dt; mobs turn to face target."""
+        n = self.count
+        alive = self.alive[:n]
+        players = np.flatnonzero(alive & ~self.is_mob[:n])
+        mobs = np.flatnonzero(alive & self.is_mob[:n])
+        self.event[:n] = IDLE
+
+        # follow_goal
+        goal_mode = self.goal_mode[players]
+        moving = players[goal_mode]
+        to_goal = self.goal[moving] - self.pos[moving]
+        dist_sq = (to_goal ** 2).sum(axis=1)
+        near = dist_sq < (ROBOT_SPEED * dt) ** 2
+        # arrive in this step, still checking walls on the way
+        self.vel[moving[near]] = to_goal[near] / dt
+        far = moving[~near]
+        to_goal = to_goal[~near]
+        self.rot[far] = -np.degrees(np.arctan2(to_goal[:, 1], to_goal[:, 0]))
+        self.vel[far] = ROBOT_SPEED * to_goal / np.sqrt(dist_sq[~near])[:, None]
+        self.rot_speed[moving] = 0
+
+        # follow_angle
+        turning = players[~goal_mode & self.angle_goal_mode[players]]
+        to_angle = (self.angle_goal[turning] - self.rot[turning] + 180) % 360 - 180
+        rot_speed = np.where(to_angle > 0, ROBOT_ROT_SPEED, -ROBOT_ROT_SPEED)
+        snap = np.abs(rot_speed * dt) > np.abs(to_angle)
+        self.rot_speed[turning] = np.where(snap, 0, rot_speed)
+        self.rot[turning[snap]] = self.angle_goal[turning[snap]]
+        self.vel[turning] = 0
+
+        self.rot[players] = (self.rot[players] + self.rot_speed[players] * dt) % 360
+
+        # move, resolving wall collisions one axis at a time, in
+        # substeps of at most SUBSTEP_SIZE hit rects so no wall is skipped
+        travel = np.abs(self.vel[players] * dt) / \
+                 (SUBSTEP_SIZE * self.size[players])
+        substeps = max(1, int(np.ceil(travel.max()))) if len(players) else 1
+        step_dt = dt / substeps
+        collided = np.zeros(len(players), dtype=bool)
+        for i in range(substeps):
+            self.pos[players, 0] += self.vel[players, 0] * step_dt
+            collided |= self.collide_axis(players, 0)
+            self.pos[players, 1] += self.vel[players, 1] * step_dt
+            collided |= self.collide_axis(players, 1)
+        self.collided[players] = collided
+        self.collisions[players] += collided & ~self.colliding[players]
+        self.colliding[players] = collided
+
+        # rounding of the last step
+        arriving = self.goal_mode[players] & ~collided & \
+                   (((self.goal[players] - self.pos[players]) ** 2).sum(axis=1) < 1e-6)
+        self.pos[players[arriving]] = self.goal[players[arriving]]
+
+        goal_mode = self.goal_mode[players]
+        reached = (self.pos[players] == self.goal[players]).all(axis=1)
+        hit_wall = goal_mode & collided & ~reached
+        arrived = goal_mode & reached
+        angle_reached = self.angle_goal_mode[players] & \
+                        (self.rot[players] == self.angle_goal[players])
+        self.event[players[hit_wall]] = HIT_WALL
+        self.event[players[arrived]] = GOAL_REACHED
+        self.event[players[angle_reached]] = ANGLE_GOAL_REACHED
+        self.goal_mode[players[hit_wall | arrived]] = False
+        self.angle_goal_mode[players[angle_reached]] = False
+
+        # idle agents stand still unless someone drives them (keyboard)
+        idle = players[~self.goal_mode[players] & ~self.angle_goal_mode[players]]
+        self.vel[idle] = 0
+        self.rot_speed[idle] = 0
+
+        # mobs face the target
+        to_target = np.array([target[0], target[1]], dtype=float) - self.pos[mobs]
+        self.rot[mobs] = -np.degrees(np.arctan2(to_target[:, 1], to_target[:, 0]))
+
+    def update_agents(self, sim_time, player):
+        """Python side of a step, only for the agents that need it.
+
+        Agents whose wait is over or whose motion ended in the last step
+        reply (or go on with their route), and the keyboard drives player
+        while it is idle.
+        """
+        n = self.count
+        alive = self.alive[:n]
+        for index in np.flatnonzero(alive & (self.wait_until[:n] <= sim_time)):
+            self.agents[index].check_wait()
+        event = self.event[:n]
+        for index in np.flatnonzero(alive & (event != IDLE)):
+            self.agents[index].finish_motion(EVENT_REPLIES[event[index]])
+
+        # keyboard input is applied in the next engine step
+        if getattr(player, 'engine', None) is self and \
+           not (player.goal_mode or player.angle_goal_mode):
+            player.get_keys()
+
+    def query(self, rect):
+        """Agents whose image may overlap the world rect."""
+        n = self.count
+        x = self.pos[:n, 0]
+        y = self.pos[:n, 1]
+        extent = self.extent[:n]
+        hit = self.alive[:n] & \
+              (x + extent > rect.left) & (x - extent < rect.right) & \
+              (y + extent > rect.top) & (y - extent < rect.bottom)
+        return [self.agents[index] for index in np.flatnonzero(hit)]
+
+def vector_field(name):
+    def get(self):
+        x, y = getattr(self.engine, name)[self.index]
+        return vec(float(x), float(y))
+
+    def set(self, value):
+        if value is not None:
+            getattr(self.engine, name)[self.index] = (value[0], value[1])
+    return property(get, set)
+
+def scalar_field(name, kind=float):
+    def get(self):
+        return kind(getattr(self.engine, name)[self.index])
+
+    def set(self, value):
+        getattr(self.engine, name)[self.index] = value
+    return property(get, set)
+
+def optional_field(name):
+    """Float field that is None while it holds NaN."""
+    def get(self):
+        value = float(getattr(self.engine, name)[self.index])
+        return None if math.isnan(value) else value
+
+    def set(self, value):
+        getattr(self.engine, name)[self.index] = np.nan if value is None else value
+    return property(get, set)
+
+class EngineSprite:
+    """Image and rect of an engine agent, rebuilt when they are read."""
+    _image_rot = None
+
+    def base_image(self):
+        raise NotImplementedError("Subclasses must override base_image()!")
+
+    def get_image(self):
+        rot = self.rot
+        if rot != self._image_rot:
+            self._image = self.game.rot_cache.rotate(self.base_image(), rot)
+            self._rect = self._image.get_rect()
+            self._image_rot = rot
+        return self._image
+
+    def set_image(self, image):
+        self._image = image
+        self._image_rot = None
+
+    def get_rect(self):
+        self.get_image()
+        self._rect.center = self.pos
+        return self._rect
+
+    def set_rect(self, rect):
+        self._rect = rect
+
+    image = property(get_image, set_image)
+    rect = property(get_rect, set_rect)
+
+    def kill(self):
+        self.engine.remove(self.index)
+        super().kill()
+
+    def update(self):
+        # stepped in bulk by AgentEngine, see update_agents()
+        pass
+
+class EnginePlayer(EngineSprite, Player):
+    pos = vector_field('pos')
+    vel = vector_field('vel')
+    goal = vector_field('goal')
+    rot = scalar_field('rot')
+    rot_speed = scalar_field('rot_speed')
+    angle_goal = scalar_field('angle_goal')
+    goal_mode = scalar_field('goal_mode', bool)
+    angle_goal_mode = scalar_field('angle_goal_mode', bool)
+    wait_until = optional_field('wait_until')
+    colliding = scalar_field('colliding', bool)
+    collisions = scalar_field('collisions', int)
+
+    def __init__(self, game, x, y):
+        self.engine = game.engine
+        self.index = self.engine.add(self, PLAYER_HIT_RECT.size,
+                                     game.player_img.get_size())
+        Player.__init__(self, game, x, y)
+        self.remove(game.updated_sprites)
+        game.sprite_index.remove(self)
+
+    def base_image(self):
+        return self.game.player_img
+
+    def get_hit_rect(self):
+        self._hit_rect.center = self.pos
+        return self._hit_rect
+
+    def set_hit_rect(self, rect):
+        self._hit_rect = rect
+
+    hit_rect = property(get_hit_rect, set_hit_rect)
+
+class EngineMob(EngineSprite, Mob):
+    pos = vector_field('pos')
+    rot = scalar_field('rot')
+
+    def __init__(self, game, x, y):
+        self.engine = game.engine
+        self.index = self.engine.add(self, game.mob_img.get_size(),
+                                     game.mob_img.get_size(), is_mob=True)
+        Mob.__init__(self, game, x, y)
+        self.remove(game.updated_sprites)
+        game.sprite_index.remove(self)
+
+    def base_image(self):
+        return self.game.mob_img
@@ -0,0 +1,97 @@
+"""Path planning on the tile grid for robot path_to / next_step commands.
+
+A tile is blocked if any wall overlaps it. The planner runs one BFS from
+the goal tile over the 4-connected free tiles and keeps the resulting
+distance field (a flow field towards the goal), so any number of robots
+asking for the same goal share a single search. Fields are kept in an
+LRU cache of PLAN_CACHE_SIZE goals; the planner itself lives as long as
+the level.
+"""
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from settings import *
+
+# (dcol, drow) and the matching rot (degrees, counterclockwise from +x)
+MOVES = [((1, 0), 0), ((0, -1), 90), ((-1, 0), 180), ((0, 1), 270)]
+
+class Planner:
+    def __init__(self, walls, width, height, cache_size=PLAN_CACHE_SIZE):
+        cols = -(-width // TILESIZE)
+        rows = -(-height // TILESIZE)
+        blocked = np.zeros((rows, cols), dtype=bool)
+        for wall in walls:
+            r = wall.rect
+            blocked[max(r.top // TILESIZE, 0):-(-r.bottom // TILESIZE),
+                    max(r.left // TILESIZE, 0):-(-r.right // TILESIZE)] = True
+        self.blocked = blocked
+        self.cache_size = cache_size
+        self.fields = OrderedDict()
+
+    def inside(self, tile):
+        rows, cols = self.blocked.shape
+        return 0 <= tile[0] < cols and 0 <= tile[1] < rows
+
+    def distance_field(self, goal):
+        """Steps from every tile to the goal (col, row) tile, -1 if unreachable."""
+        if goal in self.fields:
+            self.fields.move_to_end(goal)
+            return self.fields[goal]
+
+        rows, cols = self.blocked.shape
+        free = bytearray((~self.blocked).ravel().tobytes())
+        dist = [-1] * (rows * cols)
+        if self.inside(goal) and free[goal[1] * cols + goal[0]]:
+            start = goal[1] * cols + goal[0]
+            dist[start] = 0
+            queue = deque([start])
+            while queue:
+                index = queue.popleft()
+                d = dist[index] + 1
+                col = index % cols
+                for next_index in (index - cols, index + cols,
+                                   index - 1 if col > 0 else -1,
+                                   index + 1 if col < cols - 1 else -1):
+                    if 0 <= next_index < len(dist) and free[next_index] \
+                       and dist[next_index] < 0:
+                        dist[next_index] = d
+                        queue.append(next_index)
+        field = np.array(dist, dtype=np.int32).reshape(rows, cols)
+
+        self.fields[goal] = field
+        if len(self.fields) > self.cache_size:
+            self.fields.popitem(last=False)
+        return field
+
+    def distance(self, field, tile):
+        if not self.inside(tile):
+            return -1
+        return int(field[tile[1], tile[0]])
+
+    def runs(self, start, goal):
+        """The path from start to goal as straight (rot, tiles) runs.
+
+        Follows the flow field downhill, keeping the current direction
+        as long as that is a shortest path, so there are few turns.
+        """
+        field = self.distance_field(goal)
+        d = self.distance(field, start)
+        if d < 0:
+            raise RuntimeError("Goal unreachable")
+        runs = []
+        col, row = start
+        direction = None
+        while d > 0:
+            # MOVES is tried with the current direction first
+            moves = sorted(MOVES, key=lambda move: move[0] != direction)
+            for (dcol, drow), rot in moves:
+                if self.distance(field, (col + dcol, row + drow)) == d - 1:
+                    break
+            if (dcol, drow) == direction:
+                runs[-1][1] += 1
+            else:
+                runs.append([rot, 1])
+                direction = (dcol, drow)
+            col, row, d = col + dcol, row + drow, d - 1
+        return [tuple(run) for run in runs]
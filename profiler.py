@@ -0,0 +1,89 @@
+import csv
+import json
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from time import perf_counter
+
+from settings import *
+
+# histogram bin edges in milliseconds
+HISTOGRAM_BINS = [0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50,
+                  100, 200, 500, 1000, float('inf')]
+
+class Profiler:
+    """Timings of frame phases, sprite updates and robot commands.
+
+    Every named section keeps its last PROFILE_WINDOW samples (in
+    seconds). record() may be called from robot threads as well.
+    """
+    def __init__(self, enabled=False, window=PROFILE_WINDOW):
+        self.enabled = enabled
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, name, seconds):
+        if self.enabled:
+            self.samples[name].append(seconds)
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def stats(self, name):
+        values = sorted(self.samples[name])
+        if not values:
+            return None
+        n = len(values)
+        return {'count': n,
+                'mean_ms': 1000 * sum(values) / n,
+                'median_ms': 1000 * values[n // 2],
+                'p95_ms': 1000 * values[min(n - 1, int(0.95 * n))],
+                'max_ms': 1000 * values[-1]}
+
+    def histogram(self, name):
+        counts = [0] * (len(HISTOGRAM_BINS) - 1)
+        for value in list(self.samples[name]):
+            ms = 1000 * value
+            for i in range(len(counts)):
+                if ms < HISTOGRAM_BINS[i + 1]:
+                    counts[i] += 1
+                    break
+        return counts
+
+    def summary(self):
+        return {name: self.stats(name)
+                for name in sorted(self.samples) if self.samples[name]}
+
+    def overlay_lines(self):
+        lines = []
+        for name, stats in self.summary().items():
+            lines.append('{:<24} {:7.3f} {:7.3f} ms'.format(
+                name, stats['median_ms'], stats['p95_ms']))
+        return lines
+
+    def export(self, path):
+        """Write summary and histograms as JSON, or as CSV for *.csv."""
+        if path.endswith('.csv'):
+            with open(path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['section', 'bin_low_ms', 'bin_high_ms', 'count'])
+                for name in self.summary():
+                    counts = self.histogram(name)
+                    for i, count in enumerate(counts):
+                        writer.writerow([name, HISTOGRAM_BINS[i],
+                                         HISTOGRAM_BINS[i + 1], count])
+        else:
+            result = {}
+            for name, stats in self.summary().items():
+                stats = dict(stats)
+                stats['histogram'] = {'bins_ms': HISTOGRAM_BINS[:-1],
+                                      'counts': self.histogram(name)}
+                result[name] = stats
+            with open(path, 'w') as f:
+                json.dump(result, f, indent=2)
@@ -1,27 +1,77 @@
-from queue import Queue
-from threading import Thread
-from time import sleep
+import asyncio
+from queue import Queue, Empty
+from threading import Thread, Condition
+from time import sleep, perf_counter
 
-class Robot:
-    def __init__(self, game):
-        self.game = game
-        self.responses = Queue()
-        self.game.response_queue = self.responses
+from settings import *
 
-    def queue_clear(self):
-        q = self.responses
-        while not q.empty():
-            try:
-                q.get(False)
-            except Empty:
-                continue
-            q.task_done()
+class Channel:
+    """Command queue between one robot and its Player in the game.
 
-    def send(self, command):
-        self.queue_clear()
+    The channel also tracks whether its robot is running and how many of
+    its commands are still unanswered, so that a lockstep game can wait
+    while the robot is thinking. Once the robot's worker has exited the
+    channel is closed: queued commands are dropped and replies to
+    commands still in progress are discarded.
+    """
+    def __init__(self):
+        self.commands = Queue()
+        self.player = None
+        self.waiting_command = None
+        self.command_count = 0
+        self.active = False
+        self.closed = False
+        self.outstanding = 0
+        self.condition = Condition()
+
+    def submit(self, reply, command):
+        """Queue command; reply is called with its result by the game."""
+        def answer(result):
+            # under the lock, so the robot can't close (and e.g. shut
+            # down its event loop) in the middle of a reply
+            with self.condition:
+                if self.closed:
+                    return
+                self.outstanding -= 1
+                reply(result)
+
+        with self.condition:
+            if self.closed:
+                return
+            self.outstanding += 1
+            self.commands.put((answer, command))
+            self.condition.notify_all()
+
+    def set_active(self, active):
+        with self.condition:
+            self.active = active
+            if active:
+                self.closed = False
+            self.condition.notify_all()
 
-        self.game.command_queue.put(command)
-        return self.responses.get(block=True)
+    def close(self):
+        """Mark the robot as gone and drop all its pending commands."""
+        with self.condition:
+            self.active = False
+            self.closed = True
+            while True:
+                try:
+                    self.commands.get(block=False)
+                except Empty:
+                    break
+            self.outstanding = 0
+            self.condition.notify_all()
+
+    def wait_for_robot(self):
+        """Block while the robot runs without an unanswered command."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.active or self.outstanding > 0)
+
+class RobotCommands:
+    """Robot command API, on top of a send() provided by subclasses."""
+    def send(self, command):
+        raise NotImplementedError("Subclasses must override send()!")
 
     def turn(self, angle):
         return self.send(('turn', angle))
@@ -29,9 +79,32 @@ class Robot:
     def can_forward(self, distance, angle=None):
         return self.send(('can_forward', distance, angle))
 
+    def free_distance(self, distance, angle=None):
+        """Free distance (tiles) up to distance; angle may be a list."""
+        return self.send(('free_distance', distance, angle))
+
+    def scan(self, beams=SCAN_BEAMS, distance=SCAN_RANGE):
+        """Free distances (tiles) along beams rays around the robot,
+        starting at its heading."""
+        return self.send(('scan', beams, distance))
+
+    def path_to(self, goal='goal'):
+        """Turning points of a shortest path to goal (item type or (x, y))."""
+        return self.send(('path_to', goal))
+
+    def next_step(self, goal='goal'):
+        """(angle, tiles) to go straight towards goal, None once there."""
+        return self.send(('next_step', goal))
+
     def forward(self, distance):
         return self.send(('forward', distance))
 
+    def route(self, steps):
+        """Run motion steps ('forward', tiles), ('turn', angle) or
+        ('goto', x, y) back to back; returns (steps completed, last reply).
+        """
+        return self.send(('route', list(steps)))
+
     def status(self):
         return self.send(('status', ))
 
@@ -41,13 +114,118 @@ class Robot:
     def drop(self, item_number):
         return self.send(('drop', item_number))
 
+    def batch(self, commands):
+        """Run a list of query commands in a single frame.
+
+        commands are tuples like ('status', ) or ('can_forward', 1, 90);
+        motion commands (forward, turn) can't be batched. Returns the
+        list of results, in order.
+        """
+        return self.send(('batch', list(commands)))
+
+class Robot(RobotCommands):
+    def __init__(self, game):
+        self.game = game
+        self.channel = game.connect()
+        self.responses = Queue()
+
+    def queue_clear(self):
+        q = self.responses
+        while not q.empty():
+            try:
+                q.get(False)
+            except Empty:
+                continue
+            q.task_done()
+
+    def send(self, command):
+        self.queue_clear()
+
+        start = perf_counter()
+        self.channel.submit(self.responses.put, command)
+        response = self.responses.get(block=True)
+        self.game.profiler.record('roundtrip/' + command[0],
+                                  perf_counter() - start)
+        return response
+
     def sleep(self, seconds):
-        sleep(seconds)
+        if self.game.lockstep:
+            # the simulation waits for us, sleep in simulated time
+            self.send(('wait', seconds))
+        else:
+            sleep(seconds)
 
     def worker(self):
         raise NotImplementedError("Subclasses must override worker()!")
-        
+
+    def main(self):
+        try:
+            self.worker()
+        finally:
+            self.channel.close()
+
+    def run(self):
+        self.channel.set_active(True)
+        self.thread = Thread(target=self.main)
+        self.thread.daemon = True
+        self.thread.start()
+
+class AsyncRobot(RobotCommands):
+    """Robot whose commands return awaitables resolved by the game loop.
+
+    worker() is a coroutine running in a single asyncio event loop, so
+    a bot can e.g. poll status() while a forward() is in progress:
+
+        async def worker(self):
+            moving = asyncio.ensure_future(self.forward(3))
+            while not moving.done():
+                print(await self.status())
+            print(await moving)
+    """
+    def __init__(self, game):
+        self.game = game
+        self.channel = game.connect()
+        self.loop = None
+
+    def send(self, command):
+        loop = self.loop
+        future = loop.create_future()
+        start = perf_counter()
+
+        def resolve(result):
+            self.game.profiler.record('roundtrip/' + command[0],
+                                      perf_counter() - start)
+            if not future.cancelled():
+                future.set_result(result)
+
+        def reply(result):
+            # called from the game loop thread
+            loop.call_soon_threadsafe(resolve, result)
+
+        self.channel.submit(reply, command)
+        return future
+
+    async def sleep(self, seconds):
+        if self.game.lockstep:
+            await self.send(('wait', seconds))
+        else:
+            await asyncio.sleep(seconds)
+
+    async def worker(self):
+        raise NotImplementedError("Subclasses must override worker()!")
+
+    def main(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.worker())
+        finally:
+            # close the channel first, no reply may reach a closed loop
+            self.channel.close()
+            self.loop.close()
+
     def run(self):
-        self.thread = Thread(target=self.worker)
+        self.channel.set_active(True)
+        self.thread = Thread(target=self.main)
         self.thread.daemon = True
         self.thread.start()
@@ -5,9 +5,16 @@ WIDTH = 960 # 30 x 32
 HEIGHT = 736 # 23 x 32
 
 FONT_NAME = 'arial'
+TEXT_CACHE_SIZE = 256 # rendered text surfaces kept around
 
 TITLE = 'Medomed'
 FPS = 60
+SIM_DT = 1.0 / FPS # fixed timestep of the simulation
+# time warp: windowed runs step the simulation speed times faster than
+# real time, at most MAX_STEPS_PER_FRAME steps between two drawn frames
+TIME_WARP_SPEEDS = [1, 2, 5, 10, 20, 50]
+MAX_STEPS_PER_FRAME = 200
+MAX_FRAME_TIME = 0.25 # s of real time simulated at most per frame
 
 # Colors (R, G, B)
 BLACK = (0, 0, 0)
@@ -25,14 +32,31 @@ TILESIZE = 32
 GRIDWITH = WIDTH / TILESIZE
 DRIDHEIGHT = HEIGHT / TILESIZE
 
+# profiler keeps the last PROFILE_WINDOW samples of every section
+PROFILE_WINDOW = 1000
+
+# the map ground is rendered lazily in CHUNK_SIZE x CHUNK_SIZE pieces
+CHUNK_SIZE = 512
+CHUNK_CACHE_MB = 64
+
+# compiled TMX levels are cached on disk, relative to the game folder
+# unless absolute; MEDOMED_LEVEL_CACHE overrides the folder (empty: off)
+LEVEL_CACHE = True
+LEVEL_CACHE_FOLDER = os.environ.get('MEDOMED_LEVEL_CACHE', '.level_cache')
+
 # Player
 PLAYER_SPEED = 400
 PLAYER_IMG = 'robot_3Dblue.png'
 PLAYER_ROT_SPEED = 250
 PLAYER_HIT_RECT = pg.Rect(0, 0, 20, 20)
+SUBSTEP_SIZE = 0.5 # longest move between two wall checks, in hit rect sizes
 INVENTORY_SIZE = 3
 DROP_INTERVAL = 500
 
+# rotated sprite images are cached in ROT_CACHE_STEP degree buckets
+ROT_CACHE_STEP = 1
+ROT_CACHE_SIZE = 2048
+
 WALL_IMG = 'robot_3Dred.png'
 
 # Mobs
@@ -50,8 +74,24 @@ ITEM_IMAGES = {'apple': 'apple.png',
 ITEM_BOB_RANGE = 8
 ITEM_BOB_SPEED = 0.2
 
+# Maze level (in maze cells, each is 2x2 tiles with its walls)
+MAZE_WIDTH = 10
+MAZE_HEIGHT = 10
+MAZE_METHOD = 'auto' # 'backtracker', 'sidewinder' or 'auto' by size
+MAZE_BACKTRACKER_CELLS = 300 * 300 # larger 'auto' mazes use sidewinder
+
 # Robot
 APPROACH_RADIUS = 20
 ROBOT_ROT_SPEED = 60
 ROBOT_SPEED = 100
 ROBOT_SENSE_DIST = 150
+COMMANDS_PER_FRAME = 32 # upper bound on robot commands served in one frame
+
+# scan (lidar): SCAN_BEAMS rays up to SCAN_RANGE tiles, cast over an
+# occupancy grid with cells of at least SCAN_CELL_SIZE px
+SCAN_BEAMS = 36
+SCAN_RANGE = 10
+SCAN_CELL_SIZE = 4
+
+# path_to / next_step keep the distance fields of PLAN_CACHE_SIZE goals
+PLAN_CACHE_SIZE = 16
@@ -3,8 +3,12 @@ from settings import *
 from tilemap import collide_hit_rect
 import pytweening as tween
 import math
+import numbers
+import numpy as np
 
-from copy import deepcopy
+from collections import OrderedDict, deque
+from functools import partial
+from inspect import signature
 
 vec = pg.math.Vector2
 
@@ -28,16 +32,69 @@ def collide_with_walls(sprite, group, direction):
         return True
     return False
 
+class RotationCache:
+    """Rotated copies of images, keyed by image and quantized angle.
+
+    Angles are snapped to ROT_CACHE_STEP degrees and at most
+    ROT_CACHE_SIZE images are kept (least recently used are dropped).
+    """
+    def __init__(self, step=ROT_CACHE_STEP, size=ROT_CACHE_SIZE):
+        self.step = step
+        self.size = size
+        self.images = OrderedDict()
+
+    def rotate(self, image, angle):
+        bucket = int(round(angle / self.step)) % int(round(360 / self.step))
+        key = (image, bucket)
+        try:
+            self.images.move_to_end(key)
+            return self.images[key]
+        except KeyError:
+            pass
+        rotated = pg.transform.rotate(image, bucket * self.step)
+        self.images[key] = rotated
+        if len(self.images) > self.size:
+            self.images.popitem(last=False)
+        return rotated
+
+def sweep_rect(rect, dx, dy, walls):
+    """Fraction of the move (dx, dy) rect can make before it overlaps a wall.
+
+    Exact slab test of the moving rect against every wall rect, so thin
+    walls cannot be skipped. Touching a wall does not count as a hit,
+    the same as pg.Rect.colliderect. Returns a value in [0, 1].
+    """
+    def slab(lo, hi, d, wall_lo, wall_hi):
+        # times when [lo, hi] moving with speed d overlaps (wall_lo, wall_hi)
+        if d == 0:
+            if lo < wall_hi and hi > wall_lo:
+                return -math.inf, math.inf
+            return math.inf, -math.inf
+        t0 = (wall_lo - hi) / d
+        t1 = (wall_hi - lo) / d
+        return min(t0, t1), max(t0, t1)
+
+    t_hit = 1.0
+    for wall in walls:
+        w = wall.rect
+        x_enter, x_exit = slab(rect.left, rect.right, dx, w.left, w.right)
+        y_enter, y_exit = slab(rect.top, rect.bottom, dy, w.top, w.bottom)
+        t_enter = max(x_enter, y_enter)
+        t_exit = min(x_exit, y_exit)
+        if t_enter < t_exit and t_exit > 0 and t_enter < t_hit:
+            t_hit = max(t_enter, 0.0)
+    return t_hit
+
 class Player(pg.sprite.Sprite):
     def __init__(self, game, x, y):
         self._layer = PLAYER_LAYER
-        self.groups = game.all_sprites
+        self.groups = game.all_sprites, game.updated_sprites
         pg.sprite.Sprite.__init__(self, self.groups)
         self.game = game
         self.image = game.player_img
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
-        self.hit_rect = PLAYER_HIT_RECT
+        self.hit_rect = PLAYER_HIT_RECT.copy()
         self.hit_rect.center = self.rect.center
 
         self.vel = vec(0, 0)
@@ -52,19 +109,31 @@ class Player(pg.sprite.Sprite):
         self.goal = None
         self.goal_mode = False
         self.angle_goal_mode = False
+        self.reply = None
+        self.ready_for_command = True
+        self.route = None
+        self.route_done = 0
+        self.wait_until = None
+        self.channel = None
+        self.colliding = False
+        self.collisions = 0
+        game.sprite_index.add(self)
 
 
     def status(self):
         result = {}
-        result['pos'] = deepcopy(self.rect.center)
-        result['rot'] = deepcopy(self.rot)
-        result['inventory'] = deepcopy(self.inventory)
+        result['pos'] = tuple(self.rect.center)
+        result['rot'] = float(self.rot)
+        result['inventory'] = tuple(self.inventory)
+        result['route'] = len(self.route) if self.route is not None else 0
 
         return result
 
     def get_keys(self):
         self.vel = vec(0, 0)
         self.rot_speed = 0
+        if self.game.headless:
+            return
 
         keys = pg.key.get_pressed()
         if keys[pg.K_LEFT] or keys[pg.K_a]:
@@ -89,35 +158,39 @@ class Player(pg.sprite.Sprite):
                 except:
                     pass
 
-    def can_go_forward(self, distance, angle=None):
-        path_clear = True
+    def sweep_distance(self, distance, rot):
+        """How far (in tiles, up to distance) the hit rect can move along rot."""
+        move = vec(distance * TILESIZE, 0).rotate(-rot)
+        end_hit_rect = self.hit_rect.move(move.x, move.y)
+        walls = self.game.wall_index.query(self.hit_rect.union(end_hit_rect))
+        return distance * sweep_rect(self.hit_rect, move.x, move.y, walls)
 
-        # simulate the hitrect movement
+    def free_distance(self, distance, angle=None):
+        """Free distance in tiles for angle, or for each angle in a list."""
         if angle is None:
-            rot = self.rot
+            angle = self.rot
+        if isinstance(angle, (list, tuple)):
+            result = [self.sweep_distance(distance, rot) for rot in angle]
         else:
-            rot = angle
-
-        vel = vec(distance, 0).rotate(-rot)
-        virtual_hit_rect = deepcopy(self.hit_rect)
-
-        num_steps = distance * 4
-        for i in range(num_steps):
-            coeff = i / (num_steps - 1)
+            result = self.sweep_distance(distance, angle)
+        return result
 
-            offset = vel * coeff
+    def scan(self, beams=SCAN_BEAMS, distance=SCAN_RANGE):
+        """Free distance in tiles from the center along beams rays.
 
-            current_hit_rect = virtual_hit_rect.move(offset.x * TILESIZE,
-                                                     offset.y * TILESIZE)
-            for wall in self.game.walls:
-                if current_hit_rect.colliderect(wall.rect):
-                    path_clear = False
-                    break
-            if not path_clear:
-                break
+        Beam i points at self.rot + i * 360 / beams degrees.
+        """
+        angles = self.rot + np.arange(beams) * (360 / beams)
+        hits = self.game.occupancy_grid().raycast(self.pos, angles,
+                                                  distance * TILESIZE)
+        return (hits / TILESIZE).tolist()
 
-        self.game.response_queue.put(path_clear)
-        self.game.ready_for_command = True
+    def can_go_forward(self, distance, angle=None):
+        if angle is None:
+            rot = self.rot
+        else:
+            rot = angle
+        return self.sweep_distance(distance, rot) >= distance
 
     def go_forward(self, distance):
         self.goal = self.pos + vec(TILESIZE * distance, 0).rotate(-self.rot)
@@ -129,22 +202,93 @@ class Player(pg.sprite.Sprite):
         self.angle_goal_mode = True
         self.should_respond = True
 
+    def go_to(self, x, y):
+        self.goal = vec(x, y)
+        self.goal_mode = True
+        self.should_respond = True
+
+    def wait(self, seconds):
+        """Stand by for seconds of simulated time."""
+        self.wait_until = self.game.sim_time + seconds
+
+    def check_wait(self):
+        if self.wait_until is not None and self.game.sim_time >= self.wait_until:
+            self.wait_until = None
+            self.finish_motion("waited")
+
+    def follow_route(self, steps):
+        """Run a list of motion steps back to back.
+
+        Steps are ('forward', tiles), ('turn', angle), ('goto', x, y) or
+        ('wait', seconds); all of them are checked before the route
+        starts. The reply comes once, after the last step or the first
+        one that hits a wall: (number of steps completed, reply of the
+        last step).
+        """
+        motions = {'forward': self.go_forward,
+                   'turn': self.turn,
+                   'goto': self.go_to,
+                   'wait': self.wait}
+        route = deque()
+        for step in steps:
+            if not step or step[0] not in motions:
+                raise ValueError("Unknown route step {!r}".format(step))
+            motion, args = motions[step[0]], tuple(step[1:])
+            try:
+                signature(motion).bind(*args)
+            except TypeError:
+                raise TypeError("Wrong arguments in route step {!r}".format(step))
+            if not all(isinstance(arg, numbers.Real) for arg in args):
+                raise TypeError("Route step arguments must be numbers: {!r}".format(step))
+            route.append(partial(motion, *args))
+        if not route:
+            raise ValueError("Empty route")
+        self.route = route
+        self.route_done = 0
+        self.next_route_step()
+
+    def next_route_step(self):
+        try:
+            self.route.popleft()()
+        except Exception as e:
+            # end the route rather than the game loop
+            self.route = None
+            self.goal_mode = False
+            self.angle_goal_mode = False
+            self.wait_until = None
+            self.reply(repr(e))
+            self.ready_for_command = True
+
+    def finish_motion(self, result):
+        """Reply to the robot, or go on with the next step of a route."""
+        self.should_respond = False
+        if self.route is not None:
+            if result != "hit a wall":
+                self.route_done += 1
+                if self.route:
+                    self.next_route_step()
+                    return
+            result = (self.route_done, result)
+            self.route = None
+        self.reply(result)
+        self.ready_for_command = True
+
+    def nearby_items(self, rect):
+        # items are indexed at their resting position, allow for bobbing
+        return self.game.item_index.query(rect.inflate(0, 2 * ITEM_BOB_RANGE))
+
     def pick(self, item_name):
         if len(self.inventory) >= self.inventory_size:
             raise RuntimeError("Inventory full")
-        hits = pg.sprite.spritecollide(self, self.game.items, False, collide_hit_rect)
-        found = False
+        hits = pg.sprite.spritecollide(self, self.nearby_items(self.hit_rect),
+                                       False, collide_hit_rect)
         for hit in hits:
             if item_name == 'anything' or hit.type == item_name:
                 if hit.pickable:
                     self.inventory.append(hit.type)
                     hit.kill()
-                    self.game.response_queue.put("OK")
-                    found = True
-                    break
-        if not found:
-            self.game.response_queue.put("Not found")
-        self.game.ready_for_command = True
+                    return "OK"
+        return "Not found"
 
     def drop(self, inventory_number):
         if inventory_number < 0 or inventory_number >= len(self.inventory):
@@ -152,8 +296,7 @@ class Player(pg.sprite.Sprite):
         item_name = self.inventory.pop(inventory_number)
         Item(self.game, vec(self.rect.centerx,
                             self.rect.centery), item_name)
-        self.game.response_queue.put("Dropped {}".format(item_name))
-        self.game.ready_for_command = True
+        return "Dropped {}".format(item_name)
 
     def follow_goal(self):
         self.vel = vec(0, 0)
@@ -165,7 +308,8 @@ class Player(pg.sprite.Sprite):
         real_speed = ROBOT_SPEED * self.game.dt
         goal_dist_sq = to_goal.length_squared()
         if to_goal.length_squared() < real_speed**2:
-            self.pos = self.goal
+            # arrive in this step, still checking walls on the way
+            self.vel = to_goal / self.game.dt
         else:
             self.rot = goal_rot
             self.vel = vec(ROBOT_SPEED, 0).rotate(-goal_rot)
@@ -186,6 +330,35 @@ class Player(pg.sprite.Sprite):
             self.rot_speed = 0
             self.rot = self.angle_goal
 
+    def count_collision(self, collided):
+        if collided and not self.colliding:
+            self.collisions += 1
+        self.colliding = collided
+
+    def move(self, dt):
+        """Move by vel * dt, resolving wall collisions on the way.
+
+        The move is split into substeps of at most SUBSTEP_SIZE times
+        the hit rect size, so that no wall can be skipped at any dt.
+        Returns whether a wall was hit.
+        """
+        substeps = max(1, math.ceil(max(
+            abs(self.vel.x * dt) / (SUBSTEP_SIZE * self.hit_rect.width),
+            abs(self.vel.y * dt) / (SUBSTEP_SIZE * self.hit_rect.height))))
+        step_dt = dt / substeps
+        walls = self.game.wall_index
+        collided = False
+        for i in range(substeps):
+            self.pos.x += self.vel.x * step_dt
+            self.hit_rect.centerx = self.pos.x
+            collided = collide_with_walls(self, walls.query(self.hit_rect), 'x') or collided
+            self.pos.y += self.vel.y * step_dt
+            self.hit_rect.centery = self.pos.y
+            collided = collide_with_walls(self, walls.query(self.hit_rect), 'y') or collided
+            if not self.vel:
+                break
+        return collided
+
     def goal_reached(self):
         return self.pos == self.goal
 
@@ -193,52 +366,56 @@ class Player(pg.sprite.Sprite):
         return self.rot == self.angle_goal
 
     def update(self):
+        self.check_wait()
         if self.goal_mode:
             self.follow_goal()
         elif self.angle_goal_mode:
             self.follow_angle()
-        else:
+        elif self is self.game.player:
             self.get_keys()
+        else:
+            self.vel = vec(0, 0)
+            self.rot_speed = 0
 
         self.rot = (self.rot + self.rot_speed * self.game.dt) % 360
 
-        self.image = pg.transform.rotate(self.game.player_img, self.rot)
+        self.image = self.game.rot_cache.rotate(self.game.player_img, self.rot)
         self.rect = self.image.get_rect()
         self.hit_rect.center = self.pos
 
-        self.pos += self.vel * self.game.dt 
-
-        self.hit_rect.centerx = self.pos.x
-        collided = collide_with_walls(self, self.game.walls, 'x')
-        self.hit_rect.centery = self.pos.y
-        collided = collide_with_walls(self, self.game.walls, 'y') or collided
+        collided = self.move(self.game.dt)
+        self.count_collision(collided)
 
+        if self.goal_mode and not collided and \
+           (self.goal - self.pos).length_squared() < 1e-6:
+            # rounding of the last step
+            self.pos = vec(self.goal)
+            self.hit_rect.center = self.pos
         goal_reached = self.goal_reached()
 
         if self.goal_mode and collided and not goal_reached:
-            self.game.response_queue.put("hit a wall")
-            self.should_respond = False
             self.goal_mode = False
-            self.game.ready_for_command = True
+            self.finish_motion("hit a wall")
 
         if self.goal_mode and goal_reached:
-            self.game.response_queue.put("goal reached")
-            self.should_respond = False
             self.goal_mode = False
-            self.game.ready_for_command = True
+            self.finish_motion("goal reached")
 
         if self.angle_goal_mode and self.angle_goal_reached():
-            self.game.response_queue.put("angle goal reached")
-            self.should_respond = False
             self.angle_goal_mode = False
-            self.game.ready_for_command = True
+            self.finish_motion("angle goal reached")
 
         self.rect.center = self.hit_rect.center
+        self.game.sprite_index.move(self)
+
+    def kill(self):
+        self.game.sprite_index.remove(self)
+        pg.sprite.Sprite.kill(self)
 
 class Mob(pg.sprite.Sprite):
     def __init__(self, game, x, y):
         self._layer = MOB_LAYER
-        self.groups = game.all_sprites, game.mobs
+        self.groups = game.all_sprites, game.updated_sprites, game.mobs
         pg.sprite.Sprite.__init__(self, self.groups)
 
         self.game = game
@@ -251,13 +428,19 @@ class Mob(pg.sprite.Sprite):
         self.rect.center = self.pos
 
         self.rot = 0
+        game.sprite_index.add(self)
+
+    def kill(self):
+        self.game.sprite_index.remove(self)
+        pg.sprite.Sprite.kill(self)
 
     def update(self):
         self.rot = (self.game.player.pos - self.pos).angle_to(vec(1, 0))
 
-        self.image = pg.transform.rotate(self.game.mob_img, self.rot)
+        self.image = self.game.rot_cache.rotate(self.game.mob_img, self.rot)
         self.rect = self.image.get_rect()
         self.rect.center = self.pos
+        self.game.sprite_index.move(self)
 
 class Obstacle(pg.sprite.Sprite):
     def __init__(self, game, x, y, w, h):
@@ -282,11 +465,12 @@ class Wall(pg.sprite.Sprite):
         self.y = y
         self.rect.x = self.x * TILESIZE
         self.rect.y = self.y * TILESIZE
+        game.sprite_index.add(self)
 
 class Item(pg.sprite.Sprite):
     def __init__(self, game, pos, type, pickable=True, bobbing=True):
         self._layer = ITEMS_LAYER
-        self.groups = game.all_sprites, game.items
+        self.groups = game.all_sprites, game.updated_sprites, game.items
         pg.sprite.Sprite.__init__(self, self.groups)
 
         self.game = game
@@ -302,6 +486,14 @@ class Item(pg.sprite.Sprite):
         self.bob_step = 0
         self.bob_direction = 1
 
+        game.item_index.add(self)
+        game.sprite_index.add(self)
+
+    def kill(self):
+        self.game.item_index.remove(self)
+        self.game.sprite_index.remove(self)
+        pg.sprite.Sprite.kill(self)
+
     def update(self):
         # bobbing
         if self.bobbing:
@@ -0,0 +1,43 @@
+import random
+
+import pygame as pg
+import pytest
+
+from settings import TILESIZE
+from game import Game
+from sprites import Wall
+import levels
+
+def brute_force_visible(game, view):
+    """What the full draw loop over all_sprites would draw in view."""
+    return [sprite for sprite in game.all_sprites
+            if view.colliderect(sprite.rect)]
+
+@pytest.mark.parametrize('engine', [False, True])
+def test_visible_sprites_match_all_sprites(engine):
+    random.seed(0)
+    game = Game(headless=True, engine=engine)
+    game.set_level(levels.LevelOne)
+    game.new()
+    rng = random.Random(0)
+    width, height = game.map.width, game.map.height
+    for i in range(30):
+        Wall(game, rng.randrange(width // TILESIZE),
+             rng.randrange(height // TILESIZE))
+        game.mob_class(game, rng.randrange(width), rng.randrange(height))
+    game.player.reply = lambda result: None
+    game.player.go_forward(5)
+    mobs = game.mobs.sprites()
+    for mob in mobs[:5]:
+        mob.kill()
+
+    for step in range(60):
+        game.sim_step()
+        for mob in mobs[5:10]:
+            mob.pos += (7, 3)
+        if step % 10 == 0:
+            for x in range(0, width, 300):
+                for y in range(0, height, 300):
+                    view = pg.Rect(x, y, 400, 300)
+                    assert game.visible_sprites(view) == \
+                        brute_force_visible(game, view)
@@ -0,0 +1,34 @@
+from robot import Robot
+import user_robots
+from evaluate import run_episode
+
+class SteppingRobot(Robot):
+    """Drives to the goal one short segment at a time, with queries in
+    between, so that an episode takes many round trips."""
+    def worker(self):
+        while True:
+            self.status()
+            self.scan(8)
+            step = self.next_step('goal')
+            if step is None or isinstance(step, str):
+                return
+            angle, tiles = step
+            self.turn(angle)
+            self.forward(1)
+
+def episode(monkeypatch, bot, seed):
+    monkeypatch.setattr(user_robots, bot.__name__, bot, raising=False)
+    result = run_episode(bot.__name__, 'LevelThree', seed, max_time=60)
+    del result['wall_time']
+    return result
+
+def test_episode_is_reproducible(monkeypatch):
+    first = episode(monkeypatch, SteppingRobot, 3)
+    second = episode(monkeypatch, SteppingRobot, 3)
+    assert first['commands'] > 20
+    assert first == second
+
+def test_planner_robot_solves_level(monkeypatch):
+    result = episode(monkeypatch, user_robots.PlannerRobot, 1)
+    assert result['success']
+    assert result == episode(monkeypatch, user_robots.PlannerRobot, 1)
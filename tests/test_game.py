@@ -0,0 +1,45 @@
+import asyncio
+
+from game import Game
+from robot import Robot, AsyncRobot
+import levels
+
+class StatusRobot(Robot):
+    def worker(self):
+        self.statuses = [self.status() for i in range(3)]
+
+def test_robot_connected_after_new_gets_a_player():
+    game = Game(headless=True)
+    game.set_level(levels.LevelOne)
+    game.new()
+    first = StatusRobot(game)
+    second = StatusRobot(game)
+    assert first.channel.player is game.player
+    assert second.channel.player in game.players
+    assert second.channel.player is not game.player
+
+    first.run()
+    second.run()
+    game.run(max_steps=5)
+    for robot in [first, second]:
+        robot.thread.join(5)
+        assert len(robot.statuses) == 3
+        assert all(isinstance(status, dict) for status in robot.statuses)
+
+class QuittingRobot(AsyncRobot):
+    """Leaves a turn running when its worker returns."""
+    async def worker(self):
+        asyncio.ensure_future(self.turn(90))
+        await self.status()
+
+def test_robot_exit_does_not_stop_the_game():
+    game = Game(headless=True)
+    game.set_level(levels.LevelOne)
+    game.new()
+    robot = QuittingRobot(game)
+    robot.run()
+    game.run(max_steps=100)
+    robot.thread.join(5)
+    assert robot.channel.closed
+    assert robot.loop.is_closed()
+    assert game.player.ready_for_command
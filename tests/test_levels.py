@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+import levels
+
+def greedy_reference(grid):
+    """Cell by cell greedy meshing, the original merge_wall_cells."""
+    h, w = len(grid), len(grid[0])
+    covered = [[False] * w for row in range(h)]
+
+    def free_wall(r, c):
+        return grid[r][c] and not covered[r][c]
+
+    rects = []
+    for row in range(h):
+        for col in range(w):
+            if not free_wall(row, col):
+                continue
+            width = 1
+            while col + width < w and free_wall(row, col + width):
+                width += 1
+            height = 1
+            while row + height < h and \
+                  all(free_wall(row + height, c)
+                      for c in range(col, col + width)):
+                height += 1
+            for r in range(row, row + height):
+                for c in range(col, col + width):
+                    covered[r][c] = True
+            rects.append((row, col, height, width))
+    return rects
+
+def covered_cells(rects, shape):
+    cover = np.zeros(shape, dtype=int)
+    for row, col, height, width in rects:
+        cover[row:row + height, col:col + width] += 1
+    return cover
+
+@pytest.mark.parametrize('method', ['backtracker', 'sidewinder'])
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_wall_cells_matches_greedy_on_mazes(method, seed):
+    maze = levels.generate_maze_array(10, 10, seed=seed, method=method)
+    grid = levels.convert_to_thick_walls_array(maze)
+    rects = levels.merge_wall_cells(grid)
+    assert rects == greedy_reference(grid.tolist())
+    assert (covered_cells(rects, grid.shape) == grid).all()
+
+@pytest.mark.parametrize('seed', range(20))
+def test_merge_wall_cells_matches_greedy_on_noise(seed):
+    rng = np.random.RandomState(seed)
+    grid = rng.randint(2, size=(rng.randint(1, 15), rng.randint(1, 15)))
+    rects = levels.merge_wall_cells(grid)
+    assert rects == greedy_reference(grid.tolist())
+    assert (covered_cells(rects, grid.shape) == grid).all()
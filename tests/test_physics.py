@@ -0,0 +1,47 @@
+import random
+
+import pytest
+
+from game import Game
+import levels
+
+def scripted_run(engine, level_cls, seed, moves=12):
+    """Positions, replies, collision counts and rects of game.player
+    after each of a few random turn / forward commands."""
+    random.seed(seed)
+    game = Game(headless=True, engine=engine)
+    game.set_level(level_cls)
+    game.new()
+    player = game.player
+    replies = []
+    player.reply = replies.append
+
+    rng = random.Random(seed)
+    trace = []
+    for i in range(moves):
+        if rng.random() < 0.5:
+            player.turn(rng.choice([0, 30, 45, 90, 135, 200, 270, 333]))
+        else:
+            player.go_forward(rng.randint(1, 4))
+        player.ready_for_command = False
+        for step in range(2000):
+            game.sim_step()
+            if player.ready_for_command:
+                break
+        trace.append((player.pos.x, player.pos.y, player.rot, replies[-1],
+                      player.collisions, tuple(player.rect)))
+    return trace
+
+@pytest.mark.parametrize('level_cls', [levels.LevelOne, levels.LevelThree])
+@pytest.mark.parametrize('seed', [1, 3, 12])
+def test_engine_matches_python_player(level_cls, seed):
+    python = scripted_run(False, level_cls, seed)
+    engine = scripted_run(True, level_cls, seed)
+    for (x, y, rot, reply, collisions, rect), \
+        (ex, ey, erot, ereply, ecollisions, erect) in zip(python, engine):
+        assert reply == ereply
+        assert collisions == ecollisions
+        assert rect == erect
+        assert x == pytest.approx(ex, abs=1e-6)
+        assert y == pytest.approx(ey, abs=1e-6)
+        assert rot == pytest.approx(erot, abs=1e-6)
@@ -0,0 +1,55 @@
+import pytest
+
+from game import Game
+import levels
+
+@pytest.fixture(params=[False, True], ids=['python', 'numpy'])
+def game(request):
+    game = Game(headless=True, engine=request.param)
+    game.set_level(levels.LevelOne)
+    game.new()
+    return game
+
+def run_route(game, steps):
+    player = game.player
+    replies = []
+    player.reply = replies.append
+    player.ready_for_command = False
+    try:
+        player.follow_route(steps)
+    except Exception as e:
+        # what Game.handle_channel does with a rejected command
+        return repr(e)
+    for i in range(2000):
+        game.sim_step()
+        if player.ready_for_command:
+            break
+    assert len(replies) == 1
+    return replies[0]
+
+@pytest.mark.parametrize('steps', [
+    [('turn', 90), ('turn', )],
+    [('turn', 90), ('forward', 1, 2)],
+    [('turn', 90), ('forward', 'far')],
+    [('turn', 90), ('jump', 1)],
+    [('turn', 90), ()],
+    [],
+])
+def test_malformed_route_is_rejected(game, steps):
+    result = run_route(game, steps)
+    assert isinstance(result, str) and 'Error' in result
+    assert game.player.route is None or not steps
+    assert game.player.rot == 0
+
+def test_route_runs_steps_back_to_back(game):
+    assert run_route(game, [('turn', 180), ('wait', 0.5), ('turn', 0)]) == \
+        (3, 'angle goal reached')
+
+def test_failing_step_ends_route(game, monkeypatch):
+    def go_forward(distance):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(game.player, 'go_forward', go_forward)
+    assert run_route(game, [('turn', 90), ('forward', 1)]) == \
+        "RuntimeError('broken')"
+    assert game.player.route is None
+    assert game.player.ready_for_command
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame as pg
+import pytest
+
+from tilemap import TiledMap, CompiledMap, load_compiled_map
+
+MAP_FOLDER = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'assets', 'maps')
+
+@pytest.fixture(autouse=True)
+def display():
+    # pytmx converts the tileset images for the display
+    pg.display.init()
+    if pg.display.get_surface() is None:
+        pg.display.set_mode((1, 1))
+
+def render(compiled, rect):
+    surface = pg.Surface(rect.size)
+    compiled.render_region(surface, rect)
+    return pg.image.tostring(surface, 'RGB')
+
+@pytest.mark.parametrize('name', ['level_1.tmx', 'level_2.tmx', 'level_3.tmx'])
+def test_compiled_map_draws_like_tiled_map(name, tmp_path):
+    path = os.path.join(MAP_FOLDER, name)
+    ground = TiledMap(path).make_map()
+    compiled = CompiledMap.from_tiled(TiledMap(path))
+    load_compiled_map(path, str(tmp_path))
+    cached = load_compiled_map(path, str(tmp_path))
+    assert cached.walls == compiled.walls
+    assert cached.objects == compiled.objects
+
+    for rect in [ground.get_rect(), pg.Rect(130, 70, 300, 200)]:
+        expected = pg.image.tostring(ground.subsurface(rect), 'RGB')
+        assert render(compiled, rect) == expected
+        assert render(cached, rect) == expected
+
+def test_parallel_compiles_on_cold_cache(tmp_path):
+    path = os.path.join(MAP_FOLDER, 'level_1.tmx')
+    cache_folder = str(tmp_path / 'cache')
+    with ThreadPoolExecutor(8) as pool:
+        maps = list(pool.map(lambda i: load_compiled_map(path, cache_folder),
+                             range(16)))
+    assert all(m.walls == maps[0].walls for m in maps)
+    assert [f for f in os.listdir(cache_folder)
+            if not f.endswith('.lvl')] == []
+
+def test_unwritable_cache_is_skipped(tmp_path):
+    # a folder below a regular file can't be created, even as root
+    blocker = tmp_path / 'file'
+    blocker.write_bytes(b'')
+    path = os.path.join(MAP_FOLDER, 'level_1.tmx')
+    compiled = load_compiled_map(path, str(blocker / 'cache'))
+    assert compiled.walls == CompiledMap.from_tiled(TiledMap(path)).walls
+
+def test_game_level_cache_folder(tmp_path):
+    from game import Game
+    import levels
+    game = Game(headless=True, level_cache_folder=str(tmp_path))
+    game.set_level(levels.LevelOne)
+    game.new()
+    assert [f for f in os.listdir(str(tmp_path)) if f.endswith('.lvl')]
+    assert Game(headless=True, level_cache_folder='').level_cache_folder is None
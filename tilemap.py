@@ -1,3 +1,13 @@
+import hashlib
+import itertools
+import math
+import os
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
 import pygame as pg
 from pytmx.util_pygame import load_pygame
 import pytmx
@@ -7,6 +17,137 @@ from settings import *
 def collide_hit_rect(a, b):
     return a.hit_rect.colliderect(b.rect)
 
+class SpatialHash:
+    """Uniform grid over sprites keyed by tile.
+
+    Every sprite is registered in all cells its rect overlaps (at the
+    time it is added), so a query only has to look at the cells around
+    the query rect.
+    """
+    def __init__(self, sprites=(), cellsize=TILESIZE):
+        self.cellsize = cellsize
+        self.cells = {}
+        self.order = {}
+        self.counter = itertools.count()
+        for sprite in sprites:
+            self.add(sprite)
+
+    def cell_range(self, rect):
+        cs = self.cellsize
+        return (range(rect.left // cs, (rect.right - 1) // cs + 1),
+                range(rect.top // cs, (rect.bottom - 1) // cs + 1))
+
+    def add(self, sprite, number=None):
+        if number is None:
+            number = next(self.counter)
+        self.order[sprite] = (number, sprite.rect.copy())
+        cols, rows = self.cell_range(sprite.rect)
+        for row in rows:
+            for col in cols:
+                self.cells.setdefault((col, row), []).append(sprite)
+
+    def remove(self, sprite):
+        if sprite not in self.order:
+            return
+        number, rect = self.order.pop(sprite)
+        cols, rows = self.cell_range(rect)
+        for row in rows:
+            for col in cols:
+                cell = self.cells[(col, row)]
+                cell.remove(sprite)
+                if not cell:
+                    del self.cells[(col, row)]
+
+    def move(self, sprite):
+        """Re-register sprite at its current rect (adding it if new),
+        keeping its place in the insertion order."""
+        if sprite not in self.order:
+            self.add(sprite)
+            return
+        number, rect = self.order[sprite]
+        if rect == sprite.rect:
+            return
+        if self.cell_range(rect) == self.cell_range(sprite.rect):
+            self.order[sprite] = (number, sprite.rect.copy())
+            return
+        self.remove(sprite)
+        self.add(sprite, number)
+
+    def query(self, rect):
+        """Sprites whose cells overlap rect, in insertion order."""
+        found = set()
+        cols, rows = self.cell_range(rect)
+        for row in rows:
+            for col in cols:
+                found.update(self.cells.get((col, row), ()))
+        return sorted(found, key=lambda sprite: self.order[sprite][0])
+
+    def query_radius(self, center, radius):
+        """Candidate sprites within radius of center (not distance checked)."""
+        radius = int(math.ceil(radius))
+        return self.query(pg.Rect(center[0] - radius, center[1] - radius,
+                                  2 * radius, 2 * radius))
+
+class OccupancyGrid:
+    """Boolean grid of the cells covered by walls, for raycasting.
+
+    The cell size is the largest divisor of TILESIZE that all wall edges
+    are aligned to (exact for tile aligned walls), but not smaller than
+    SCAN_CELL_SIZE; cells partly covered by a wall count as occupied.
+    Everything outside the map is occupied too.
+    """
+    def __init__(self, walls, width, height):
+        rects = [wall.rect for wall in walls]
+        cs = TILESIZE
+        for r in rects:
+            cs = math.gcd(cs, math.gcd(math.gcd(r.left, r.top),
+                                       math.gcd(r.width, r.height)))
+        self.cellsize = cs = max(cs, SCAN_CELL_SIZE)
+        self.grid = np.zeros((-(-height // cs), -(-width // cs)), dtype=bool)
+        for r in rects:
+            self.grid[max(r.top // cs, 0):-(-r.bottom // cs),
+                      max(r.left // cs, 0):-(-r.right // cs)] = True
+
+    def raycast(self, origin, angles, max_distance):
+        """Distance (px, up to max_distance) to the first occupied cell
+        along each angle (degrees, same convention as sprite rot).
+
+        Every ray is cut at the cell borders it crosses (a vectorized
+        DDA), so the distances are exact for the grid.
+        """
+        rad = np.radians(-np.asarray(angles, dtype=float))
+        direction = np.stack([np.cos(rad), np.sin(rad)], axis=1)
+        cs = self.cellsize
+        n = int(max_distance // cs) + 2
+        steps = np.arange(n) * cs
+        crossings = [np.zeros((len(rad), 1))]
+        for axis in range(2):
+            d = direction[:, axis:axis + 1]
+            o = origin[axis]
+            first = np.where(d > 0, (o // cs + 1) * cs, o // cs * cs)
+            border = first + np.where(d > 0, steps, -steps)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (border - o) / d
+            crossings.append(np.where(np.isfinite(t) & (t >= 0), t, np.inf))
+        t = np.minimum(np.sort(np.concatenate(crossings, axis=1), axis=1),
+                       max_distance)
+
+        # the cell of each segment between two crossings is the one
+        # around its middle point
+        mid = (t[:, :-1] + t[:, 1:]) / 2
+        x = origin[0] + direction[:, 0:1] * mid
+        y = origin[1] + direction[:, 1:2] * mid
+        rows, cols = self.grid.shape
+        col = np.floor(x / cs).astype(np.int64)
+        row = np.floor(y / cs).astype(np.int64)
+        outside = (col < 0) | (col >= cols) | (row < 0) | (row >= rows)
+        hit = outside | self.grid[np.clip(row, 0, rows - 1),
+                                  np.clip(col, 0, cols - 1)]
+        hit &= t[:, :-1] < max_distance
+        first = hit.argmax(axis=1)
+        return np.where(hit.any(axis=1), t[np.arange(len(t)), first],
+                        max_distance)
+
 class Map:
     def __init__(self, width, height):
         self.layers = []
@@ -19,24 +160,262 @@ class Map:
         self.height = self.tileheight * TILESIZE
 
 class TileSet:
+    """Tile atlas over a single sheet.
+
+    Tiles are subsurface views into the sheet (no copy, per-pixel alpha
+    kept) and are cached, so every tile is looked up only once.
+    """
     def __init__(self, filename, tilesize):
         self.tilesize = tilesize
         self.tileset = pg.image.load(filename).convert_alpha()
         self.width = self.tileset.get_size()[0] // self.tilesize
+        self.height = self.tileset.get_size()[1] // self.tilesize
+        self.tiles = {}
 
     def __getitem__(self, coords):
-        if isinstance(coords, int):
+        if isinstance(coords, tuple):
+            y, x = coords
+            coords = y * self.width + x
+        coords = int(coords)
+        if coords not in self.tiles:
             y = coords // self.width
             x = coords % self.width
-        else:
-            y, x = coords
-        tile = pg.Surface((self.tilesize, self.tilesize))
-        tileset_x = x * self.tilesize
-        tileset_y = y * self.tilesize
-        tile.blit(self.tileset, (0, 0),
-                  (tileset_x, tileset_y,
-                   self.tilesize, self.tilesize))
-        return tile
+            self.tiles[coords] = self.tileset.subsurface(
+                (x * self.tilesize, y * self.tilesize,
+                 self.tilesize, self.tilesize))
+        return self.tiles[coords]
+
+    def get_many(self, ids):
+        """Tiles for a sequence (or nested sequence / array) of tile ids."""
+        if hasattr(ids, 'tolist'):
+            ids = ids.tolist()
+        return [self.get_many(id) if isinstance(id, list) else self[id]
+                for id in ids]
+
+def merge_rects(rects):
+    """Merge (x, y, w, h) rectangles that share a whole edge.
+
+    Neighbours in a row with the same y and height are joined first,
+    then stacked rectangles with the same x and width.
+    """
+    rects = sorted(rects, key=lambda r: (r[1], r[3], r[0]))
+    rows = []
+    for x, y, w, h in rects:
+        if rows:
+            px, py, pw, ph = rows[-1]
+            if py == y and ph == h and px + pw == x:
+                rows[-1] = (px, py, pw + w, ph)
+                continue
+        rows.append((x, y, w, h))
+
+    rows.sort(key=lambda r: (r[0], r[2], r[1]))
+    merged = []
+    for x, y, w, h in rows:
+        if merged:
+            px, py, pw, ph = merged[-1]
+            if px == x and pw == w and py + ph == y:
+                merged[-1] = (px, py, pw, ph + h)
+                continue
+        merged.append((x, y, w, h))
+    return merged
+
+SpawnObject = namedtuple('SpawnObject', 'name x y width height')
+
+class CompiledMap:
+    """Tile layers, merged wall rects and spawn list of a TMX map.
+
+    Stored as a compact binary file: a header, fixed-size wall, object
+    and tile format records and a zlib-compressed block with the tile
+    index layers and the RGBA images of the tiles they use, so that
+    later runs skip TMX and tileset parsing. The ground is drawn from
+    the layers chunk by chunk (render_region), never as a whole.
+    """
+    MAGIC = b'MEDL'
+    VERSION = 2
+    HEADER = struct.Struct('<4sIIIIIIIII')
+    RECT = struct.Struct('<4d')
+    NAME = struct.Struct('<H')
+    # width, height, per-pixel alpha, colorkey as 0xRRGGBB or -1
+    TILE = struct.Struct('<HH?i')
+
+    def __init__(self, cols, rows, tilewidth, tileheight, layers, tiles,
+                 walls, objects):
+        self.cols = cols
+        self.rows = rows
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.width = cols * tilewidth
+        self.height = rows * tileheight
+        # layers[i][row][col] is 0 for no tile or 1 + an index into tiles
+        self.layers = layers
+        self.tiles = tiles
+        self.walls = walls
+        self.objects = objects
+
+    @classmethod
+    def from_tiled(cls, tiled_map):
+        tmx = tiled_map.tmxdata
+        walls = []
+        objects = []
+        for tile_object in tmx.objects:
+            rect = (tile_object.x, tile_object.y,
+                    tile_object.width, tile_object.height)
+            if tile_object.name == 'wall':
+                walls.append(rect)
+            else:
+                objects.append(SpawnObject(tile_object.name, *rect))
+
+        tiles = []
+        numbers = {}
+        layers = []
+        for layer in tmx.visible_layers:
+            if not isinstance(layer, pytmx.TiledTileLayer):
+                continue
+            rows = []
+            for row in layer.data:
+                numbers_row = []
+                for gid in row:
+                    if gid not in numbers:
+                        tile = tmx.get_tile_image_by_gid(gid) if gid else None
+                        numbers[gid] = 0
+                        if tile:
+                            tiles.append(tile)
+                            numbers[gid] = len(tiles)
+                    numbers_row.append(numbers[gid])
+                rows.append(numbers_row)
+            layers.append(rows)
+        return cls(tmx.width, tmx.height, tmx.tilewidth, tmx.tileheight,
+                   layers, tiles, merge_rects(walls), objects)
+
+    def save(self, path):
+        parts = [self.HEADER.pack(self.MAGIC, self.VERSION,
+                                  self.cols, self.rows,
+                                  self.tilewidth, self.tileheight,
+                                  len(self.layers), len(self.tiles),
+                                  len(self.walls), len(self.objects))]
+        for rect in self.walls:
+            parts.append(self.RECT.pack(*rect))
+        for tile_object in self.objects:
+            name = (tile_object.name or '').encode('utf-8')
+            parts.append(self.NAME.pack(len(name)) + name)
+            parts.append(self.RECT.pack(*tile_object[1:]))
+        block = [np.array(self.layers, dtype='<u2').tobytes()]
+        for tile in self.tiles:
+            alpha = bool(tile.get_flags() & pg.SRCALPHA)
+            colorkey = tile.get_colorkey()
+            key = -1 if colorkey is None else \
+                  (colorkey[0] << 16) | (colorkey[1] << 8) | colorkey[2]
+            parts.append(self.TILE.pack(tile.get_width(), tile.get_height(),
+                                        alpha, key))
+            block.append(pg.image.tostring(tile, 'RGBA' if alpha else 'RGB'))
+        parts.append(zlib.compress(b''.join(block)))
+
+        # write to a private temporary file first so readers never see
+        # half a file and parallel writers do not clash
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b''.join(parts))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, cols, rows, tilewidth, tileheight, \
+            n_layers, n_tiles, n_walls, n_objects = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("not a compiled level: {}".format(path))
+        offset = cls.HEADER.size
+
+        walls = []
+        for i in range(n_walls):
+            walls.append(cls.RECT.unpack_from(data, offset))
+            offset += cls.RECT.size
+        objects = []
+        for i in range(n_objects):
+            length, = cls.NAME.unpack_from(data, offset)
+            offset += cls.NAME.size
+            name = data[offset:offset + length].decode('utf-8') or None
+            offset += length
+            objects.append(SpawnObject(name, *cls.RECT.unpack_from(data, offset)))
+            offset += cls.RECT.size
+        formats = []
+        for i in range(n_tiles):
+            formats.append(cls.TILE.unpack_from(data, offset))
+            offset += cls.TILE.size
+
+        block = zlib.decompress(data[offset:])
+        count = n_layers * rows * cols
+        layers = np.frombuffer(block, dtype='<u2', count=count)
+        layers = layers.reshape(n_layers, rows, cols).tolist()
+        offset = 2 * count
+        converted = pg.display.get_surface() is not None
+        tiles = []
+        for width, height, alpha, key in formats:
+            end = offset + (4 if alpha else 3) * width * height
+            tile = pg.image.fromstring(block[offset:end], (width, height),
+                                       'RGBA' if alpha else 'RGB')
+            if key >= 0:
+                tile.set_colorkey((key >> 16, (key >> 8) & 0xff, key & 0xff))
+            if converted:
+                tile = tile.convert_alpha() if alpha else tile.convert()
+            tiles.append(tile)
+            offset = end
+        if offset != len(block):
+            raise ValueError("broken compiled level: {}".format(path))
+        return cls(cols, rows, tilewidth, tileheight, layers, tiles,
+                   walls, objects)
+
+    def render_region(self, surface, rect):
+        """Render only the tiles inside the world rect, offset to (0, 0)."""
+        tw = self.tilewidth
+        th = self.tileheight
+        cols = range(max(rect.left // tw, 0),
+                     min((rect.right - 1) // tw + 1, self.cols))
+        rows = range(max(rect.top // th, 0),
+                     min((rect.bottom - 1) // th + 1, self.rows))
+
+        tiles = self.tiles
+        for layer in self.layers:
+            for y in rows:
+                row = layer[y]
+                for x in cols:
+                    number = row[x]
+                    if number:
+                        surface.blit(tiles[number - 1], (x * tw - rect.x,
+                                                         y * th - rect.y))
+
+def load_compiled_map(filename, cache_folder=None):
+    """CompiledMap of a TMX file, cached by the hash of the file content.
+
+    Without a cache_folder the map is compiled in memory every time, and
+    a cache that can't be written (read-only checkout, full disk) is
+    skipped.
+    """
+    path = None
+    if cache_folder is not None:
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        path = os.path.join(cache_folder, digest + '.lvl')
+        if os.path.exists(path):
+            try:
+                return CompiledMap.load(path)
+            except (OSError, ValueError, struct.error, zlib.error):
+                pass # stale or broken cache file, compile again
+
+    compiled = CompiledMap.from_tiled(TiledMap(filename))
+    if path is not None:
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            compiled.save(path)
+        except OSError:
+            pass # the level works just as well without the cache
+    return compiled
 
 class TiledMap:
     def __init__(self, filename):
@@ -62,6 +441,54 @@ class TiledMap:
         self.render(temp_surface)
         return temp_surface
 
+class ChunkedMap:
+    """Map ground drawn from CHUNK_SIZE pieces rendered on demand.
+
+    render_region(surface, rect) must draw the part of the map inside
+    the world rect onto surface at (0, 0). Chunks are rendered the first
+    time they are seen and the least recently used ones are dropped
+    once the cache exceeds CHUNK_CACHE_MB.
+    """
+    def __init__(self, width, height, render_region,
+                 chunk_size=CHUNK_SIZE, cache_mb=CHUNK_CACHE_MB):
+        self.width = width
+        self.height = height
+        self.rect = pg.Rect(0, 0, width, height)
+        self.render_region = render_region
+        self.chunk_size = chunk_size
+        chunk_bytes = 4 * chunk_size * chunk_size
+        self.max_chunks = max(1, cache_mb * 1024 * 1024 // chunk_bytes)
+        self.chunks = OrderedDict()
+
+    def chunk(self, col, row):
+        key = (col, row)
+        try:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        except KeyError:
+            pass
+        cs = self.chunk_size
+        rect = pg.Rect(col * cs, row * cs, cs, cs).clip(self.rect)
+        surface = pg.Surface(rect.size)
+        self.render_region(surface, rect)
+        self.chunks[key] = surface
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return surface
+
+    def draw(self, screen, camera, area=None):
+        """Blit the chunks visible through camera (or only inside area)."""
+        if area is None:
+            area = screen.get_rect()
+        view = camera.to_world(area).clip(self.rect)
+        if not view.width or not view.height:
+            return
+        cs = self.chunk_size
+        for row in range(view.top // cs, (view.bottom - 1) // cs + 1):
+            for col in range(view.left // cs, (view.right - 1) // cs + 1):
+                pos = camera.apply_rect(pg.Rect(col * cs, row * cs, cs, cs))
+                screen.blit(self.chunk(col, row), pos)
+
 class Camera:
     def __init__(self, width, height):
         self.camera = pg.Rect(0, 0, width, height)
@@ -74,6 +501,10 @@ class Camera:
     def apply_rect(self, rect):
         return rect.move(self.camera.topleft)
 
+    def to_world(self, rect):
+        """Screen rect -> world rect, the inverse of apply_rect."""
+        return rect.move(-self.camera.x, -self.camera.y)
+
     def update(self, target):
         x = -target.rect.centerx + int(WIDTH / 2)
         y = -target.rect.centery + int(HEIGHT / 2)
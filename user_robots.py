@@ -1,4 +1,5 @@
-from robot import Robot
+import asyncio
+from robot import Robot, AsyncRobot
 from pprint import pprint
 import pygame as pg
 vec = pg.math.Vector2
@@ -9,3 +10,20 @@ class TestRobot(Robot):
             status = self.status()
             pprint(status)
             self.sleep(2)
+
+class PlannerRobot(Robot):
+    def worker(self):
+        waypoints = self.path_to('goal')
+        if isinstance(waypoints, str):
+            print(waypoints)
+            return
+        print(self.route([('goto', x, y) for x, y in waypoints]))
+
+class TestAsyncRobot(AsyncRobot):
+    async def worker(self):
+        while True:
+            status, free = await asyncio.gather(self.status(),
+                                                self.free_distance(5))
+            pprint(status)
+            pprint(free)
+            await self.sleep(2)